@@ -0,0 +1,198 @@
+"""
+Summary statistics of many TVAC log files (TEMP_plotter and psuInterface logs, CSV or binary), computed in parallel:
+the files are spread over a pool of processes, each one parses its file in chunks and returns the statistics
+of each column, merged at the end in a single table.
+"""
+
+import os
+import sys
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from tvacStorage import isBinary, readBinary
+
+class SummaryStats:
+  """
+  Statistics of the columns of a log, accumulated chunk by chunk:
+  number of samples, time span, min, max, mean; for the temperatures (columns 'pt...') also
+  the time spent within a band (each sample holds until the next one) and the thermal cycles,
+  counted with hysteresis at each crossing of the high threshold after the low one.
+  """
+  def __init__(self, columns: list, band: tuple, cycle: tuple):
+    """
+    Parameters
+    ----------
+    columns : list
+      Column names
+    band : tuple
+      Low and high limit of the band, in degC
+    cycle : tuple
+      Low and high threshold of the thermal cycles, in degC
+    """
+    self.columns = list(columns)
+    self.band = band
+    self.cycle = cycle
+    n = len(self.columns)
+    self.isTemp = np.array([col.startswith('pt') for col in self.columns])
+    self.count = np.zeros(n, dtype=int)
+    self.sum = np.zeros(n)
+    self.min = np.full(n, np.inf)
+    self.max = np.full(n, -np.inf)
+    self.dwell = np.zeros(n)
+    self.cycles = np.zeros(n, dtype=int)
+    self.state = np.zeros(n, dtype=int) # -1: below the low threshold, +1: above the high one, 0: not yet known
+    self.first = None
+    self.lastTime = None
+    self.lastValues = None
+  
+  def update(self, times, values):
+    """
+    Add a chunk of rows: times (unix time) and values, shape (rows, columns)
+    """
+    if len(times) == 0:
+      return
+    valid = ~np.isnan(values)
+    self.count += valid.sum(axis=0)
+    self.sum += np.where(valid, values, 0).sum(axis=0)
+    self.min = np.fmin(self.min, np.nanmin(np.where(valid, values, np.inf), axis=0))
+    self.max = np.fmax(self.max, np.nanmax(np.where(valid, values, -np.inf), axis=0))
+    
+    #Dwell time: each sample holds until the next one, also across the chunks
+    if self.lastTime is not None:
+      times = np.concatenate(([self.lastTime], times))
+      held = np.vstack((self.lastValues, values[:-1]))
+    else:
+      self.first = times[0]
+      held = values[:-1]
+    inBand = (held >= self.band[0]) & (held <= self.band[1])
+    self.dwell += (np.diff(times)[:, None] * inBand).sum(axis=0)
+    self.lastTime = times[-1]
+    self.lastValues = values[-1]
+    
+    #Thermal cycles: sequence of the threshold crossings of each column, starting from the state of the previous chunk
+    levels = np.where(values <= self.cycle[0], -1, np.where(values >= self.cycle[1], 1, 0))
+    for it in np.flatnonzero(self.isTemp):
+      events = levels[:, it][levels[:, it] != 0]
+      if not len(events):
+        continue
+      events = np.concatenate(([self.state[it]], events))
+      self.cycles[it] += np.count_nonzero((events[:-1] == -1) & (events[1:] == 1))
+      self.state[it] = events[-1]
+  
+  def result(self):
+    """
+    Statistics of each column
+    
+    Returns
+    -------
+    pandas.DataFrame
+      One row per column
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+      mean = self.sum/self.count
+    return pd.DataFrame({
+      'column': self.columns,
+      'samples': self.count,
+      'start': self.first,
+      'end': self.lastTime,
+      'min': np.where(self.count > 0, self.min, np.nan),
+      'max': np.where(self.count > 0, self.max, np.nan),
+      'mean': mean,
+      'dwell_s': np.where(self.isTemp, self.dwell, np.nan),
+      'cycles': np.where(self.isTemp, self.cycles, np.nan)
+    })
+
+def readChunks(logFile: str, chunksize: int= 100000):
+  """
+  Read a log in chunks: TEMP_plotter CSV, psuInterface CSV (header in the '#Time Stamp, ...' comment) or binary log
+  
+  Parameters
+  ----------
+  logFile : str
+    Log file
+  chunksize : int, optional
+    Rows read at a time; default: 100000
+  
+  Yields
+  ------
+  pandas.DataFrame
+    Rows of the chunk: Timestamp, then the columns of the log
+  """
+  if isBinary(logFile):
+    records = readBinary(logFile)[1]
+    for it in range(0, len(records), chunksize):
+      yield pd.DataFrame(records[it:it+chunksize])
+    return
+  names = None
+  with open(logFile) as f:
+    for line in f:
+      if not line.startswith('#'):
+        break
+      if line.startswith('#Time Stamp'):
+        names = ['Timestamp'] + [col.strip() for col in line.split(',')[1:]]
+  for chunk in pd.read_csv(logFile, comment='#', header=None if names else 0, names=names, chunksize=chunksize):
+    #Header lines repeated by a new logging session are not numbers: drop them
+    yield chunk.apply(pd.to_numeric, errors='coerce').dropna(subset=[chunk.columns[0]])
+
+def summarize(logFile: str, band: tuple= (-20., 30.), cycle: tuple= (-20., 30.), chunksize: int= 100000):
+  """
+  Statistics of the columns of a log file (runs in a worker process)
+  
+  Parameters
+  ----------
+  logFile : str
+    Log file
+  band : tuple, optional
+    Low and high limit of the band of the dwell time, in degC; default: (-20, 30)
+  cycle : tuple, optional
+    Low and high threshold of the thermal cycles, in degC; default: (-20, 30)
+  chunksize : int, optional
+    Rows read at a time; default: 100000
+  
+  Returns
+  -------
+  pandas.DataFrame
+    Statistics of each column; a single row with the error if the file could not be read
+  """
+  try:
+    stats = None
+    for chunk in readChunks(logFile, chunksize):
+      if stats is None:
+        stats = SummaryStats(chunk.columns[1:], band, cycle)
+      stats.update(chunk.iloc[:, 0].to_numpy(dtype=float), chunk.iloc[:, 1:].to_numpy(dtype=float))
+    if stats is None:
+      raise ValueError('no data')
+    result = stats.result()
+  except Exception as e:
+    result = pd.DataFrame({'column': [None], 'error': [str(e)]})
+  result.insert(0, 'file', os.path.basename(logFile))
+  return result
+
+def main():
+  parser = argparse.ArgumentParser(description='Summary statistics of TVAC log files, computed in parallel')
+  parser.add_argument('logs', nargs='+', help='log files or glob patterns (e.g. log/temp_plotter_*.txt)')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default: number of cores)')
+  parser.add_argument('--band', type=float, nargs=2, default=[-20., 30.], metavar=('LOW', 'HIGH'), help='band of the dwell time, in degC (default: -20 30)')
+  parser.add_argument('--cycle', type=float, nargs=2, default=None, metavar=('LOW', 'HIGH'), help='thresholds of the thermal cycles, in degC (default: the band)')
+  parser.add_argument('--chunksize', type=int, default=100000, help='rows read at a time (default: 100000)')
+  parser.add_argument('--out', default='batch_summary.csv', help='output table (default: batch_summary.csv)')
+  args = parser.parse_args()
+  
+  logFiles = sorted({path for pattern in args.logs for path in (glob.glob(pattern) or [pattern])})
+  #A binary log is made of two files: read it once; skip the time indexes of the CSV logs
+  logFiles = [path for path in logFiles if not path.endswith('.idx') and (not path.endswith('.bin') or os.path.splitext(path)[0]+'.json' not in logFiles)]
+  cycle = args.cycle if args.cycle else args.band
+  
+  with ProcessPoolExecutor(max_workers=args.workers) as pool:
+    results = list(pool.map(summarize, logFiles, [tuple(args.band)]*len(logFiles), [tuple(cycle)]*len(logFiles), [args.chunksize]*len(logFiles)))
+  
+  table = pd.concat(results, ignore_index=True)
+  table.to_csv(args.out, index=False)
+  with pd.option_context('display.max_rows', None, 'display.width', None):
+    print(table)
+  print(f'{len(logFiles)} files, summary written to {args.out}')
+
+if __name__ == '__main__':
+  main()
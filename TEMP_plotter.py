@@ -2,10 +2,14 @@ import sys
 import pyqtgraph as pg
 import time
 import datetime
+import threading
+import argparse
+import contextlib
 
 from psu import *
 from utils import *
 from daq970a import *
+from tvacStorage import openLog, formats
 
 from pyqtgraph import GraphicsLayoutWidget
 from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
@@ -21,13 +25,13 @@ import matplotlib.pyplot as plt
 
 
 class PlotTempWidget(QtWidgets.QMainWindow):
-    def __init__(self, title, xlabel, ylabel, channel, psu):
+    def __init__(self, title, xlabel, ylabel, channel, psu, window=7200, period=60):
         self.psu = psu
-        self.init_single_plot()
+        self.init_single_plot(window, period)
         self.name = "PlotTempWidget"
     
-    #Plot several channels in the same plot
-    def init_single_plot(self):
+    #Plot several channels in the same plot; window and period (in seconds) size the history buffers
+    def init_single_plot(self, window, period):
         super().__init__()
 
         psu_channelsU = self.psu.lenDict['u']
@@ -79,25 +83,11 @@ class PlotTempWidget(QtWidgets.QMainWindow):
         self.temp_P1S_plot_graph.addLegend(offset=(1,1))
         self.temp_P1S_plot_graph.showGrid(x=True, y=True)
 
-        self.time = []
-        
-        # Empty list of lists for temperatures
-        self.temperaturesU = []
-        self.temperaturesY = []
-        self.temperaturesEXT = []
-        self.temperaturesP1S = []
-
-        for it in range(0, psu_channelsU):
-            self.temperaturesU.append([])
-
-        for it in range(0, psu_channelsY):
-            self.temperaturesY.append([])
-
-        for it in range(0, psu_channelsEXT):
-            self.temperaturesEXT.append([])
-
-        for it in range(0, psu_channelsP1S):
-            self.temperaturesP1S.append([])
+        # History buffers for temperatures
+        self.temperaturesU = RingBuffer(psu_channelsU, window, period)
+        self.temperaturesY = RingBuffer(psu_channelsY, window, period)
+        self.temperaturesEXT = RingBuffer(psu_channelsEXT, window, period)
+        self.temperaturesP1S = RingBuffer(psu_channelsP1S, window, period)
 
 
         # Plot line reference for currents
@@ -110,8 +100,8 @@ class PlotTempWidget(QtWidgets.QMainWindow):
 
         for it in range(0, psu_channelsU):
             temp_Uline = self.temp_U_plot_graph.plot(
-                self.time,
-                self.temperaturesU[it],
+                self.temperaturesU.times(),
+                self.temperaturesU.channel(it),
                 #name = f"Temperature ch.{it}",
                 name = self.psu.nameDict[self.psu.planeDict['u'][it]],
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
@@ -122,8 +112,8 @@ class PlotTempWidget(QtWidgets.QMainWindow):
             
         for it in range(0, psu_channelsY):
             temp_Yline = self.temp_Y_plot_graph.plot(
-                self.time,
-                self.temperaturesY[it],
+                self.temperaturesY.times(),
+                self.temperaturesY.channel(it),
                 #name=f"Temperature ch.{it}",
                 name = self.psu.nameDict[self.psu.planeDict['y'][it]],
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
@@ -134,8 +124,8 @@ class PlotTempWidget(QtWidgets.QMainWindow):
 
         for it in range(0, psu_channelsEXT):
             temp_EXTline = self.temp_EXT_plot_graph.plot(
-                self.time,
-                self.temperaturesEXT[it],
+                self.temperaturesEXT.times(),
+                self.temperaturesEXT.channel(it),
                 #name=f"Temperature ch.{it}",
                 name = self.psu.nameDict[self.psu.planeDict['ext'][it]],
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
@@ -146,8 +136,8 @@ class PlotTempWidget(QtWidgets.QMainWindow):
 
         for it in range(0, psu_channelsP1S):
             temp_P1Sline = self.temp_P1S_plot_graph.plot(
-                self.time,
-                self.temperaturesP1S[it],
+                self.temperaturesP1S.times(),
+                self.temperaturesP1S.channel(it),
                 #name=f"Temperature ch.{it}",
                 name = self.psu.nameDict[self.psu.planeDict['p1s'][it]],
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
@@ -155,50 +145,37 @@ class PlotTempWidget(QtWidgets.QMainWindow):
                 #symbolBrush=colormap(it),
             )
             self.temp_P1S_plots.append(temp_P1Sline)
+
+        # Level-of-detail layers: decimated curves for the visible range
+        self.lod_U = LodPlot(self.temp_U_plot_graph, self.temp_U_plots, self.temperaturesU)
+        self.lod_Y = LodPlot(self.temp_Y_plot_graph, self.temp_Y_plots, self.temperaturesY)
+        self.lod_EXT = LodPlot(self.temp_EXT_plot_graph, self.temp_EXT_plots, self.temperaturesEXT)
+        self.lod_P1S = LodPlot(self.temp_P1S_plot_graph, self.temp_P1S_plots, self.temperaturesP1S)
     
     def update_temps(self, ts, tempsU, tempsY, tempsEXT, tempsP1S):
-        #Discard data older than 2 hours and append time
-        if len(self.time) > 120:
-            self.time = self.time[1:]
-            for channel in range(0, len(tempsU)):
-                self.temperaturesU[channel] = self.temperaturesU[channel][1:]
-            for channel in range(0, len(tempsY)):
-                self.temperaturesY[channel] = self.temperaturesY[channel][1:]
-            for channel in range(0, len(tempsEXT)):
-                self.temperaturesEXT[channel] = self.temperaturesEXT[channel][1:]
-            for channel in range(0, len(tempsP1S)):
-                self.temperaturesP1S[channel] = self.temperaturesP1S[channel][1:]
-        self.time.append(ts)
+        #Append the sample: the buffers discard the data older than the plot window
+        self.temperaturesU.append(ts, tempsU)
+        self.temperaturesY.append(ts, tempsY)
+        self.temperaturesEXT.append(ts, tempsEXT)
+        self.temperaturesP1S.append(ts, tempsP1S)
         #Plot all temperatures
-        for channel in range(0, len(tempsU)):
-            self.temperaturesU[channel].append(tempsU[channel])
-            self.temp_U_plots[channel].setData(self.time, self.temperaturesU[channel])
-
-        for channel in range(0, len(tempsY)):
-            self.temperaturesY[channel].append(tempsY[channel])
-            self.temp_Y_plots[channel].setData(self.time, self.temperaturesY[channel])
-            self.temp_Y_plots[channel].setData(self.time, self.temperaturesY[channel])
-
-        for channel in range(0, len(tempsEXT)):
-            self.temperaturesEXT[channel].append(tempsEXT[channel])
-            self.temp_EXT_plots[channel].setData(self.time, self.temperaturesEXT[channel])
-
-        for channel in range(0, len(tempsP1S)):
-            self.temperaturesP1S[channel].append(tempsP1S[channel])
-            self.temp_P1S_plots[channel].setData(self.time, self.temperaturesP1S[channel])
+        self.lod_U.refresh()
+        self.lod_Y.refresh()
+        self.lod_EXT.refresh()
+        self.lod_P1S.refresh()
     
     def update_currs_volts_pwrs(self, ts, currs, volts, pwrs):
         pass
     
             
 class PlotPSUWidget(QtWidgets.QMainWindow):
-    def __init__(self, title, xlabel, ylabel, channel, psu):
+    def __init__(self, title, xlabel, ylabel, channel, psu, window=7200, period=60):
         self.psu = psu
-        self.init_single_plot(psuChannels=4)
+        self.init_single_plot(window, period, psuChannels=4)
         self.name = "PsuTempWidget"
     
-    #Plot several channels in the same plot
-    def init_single_plot(self, psuChannels=3):
+    #Plot several channels in the same plot; window and period (in seconds) size the history buffers
+    def init_single_plot(self, window, period, psuChannels=3):
         super().__init__()
 
         # Dynamic plot for voltages
@@ -234,17 +211,10 @@ class PlotPSUWidget(QtWidgets.QMainWindow):
         self.power_plot_graph.addLegend(offset=(1,1))
         self.power_plot_graph.showGrid(x=True, y=True)
 
-        self.time = []
-        
-        # Empty list of lists
-        self.voltages = []
-        self.currents = []
-        self.powers = []
-
-        for it in range(0, psuChannels):
-            self.voltages.append([])
-            self.currents.append([])
-            self.powers.append([])
+        # History buffers
+        self.voltages = RingBuffer(psuChannels, window, period)
+        self.currents = RingBuffer(psuChannels, window, period)
+        self.powers = RingBuffer(psuChannels, window, period)
 
         # Plot line reference for currents
         colormap = plt.colormaps['tab20'] 
@@ -255,8 +225,8 @@ class PlotPSUWidget(QtWidgets.QMainWindow):
 
         for it in range(0, psuChannels):
             volt_line = self.volt_plot_graph.plot(
-                self.time,
-                self.voltages[it],
+                self.voltages.times(),
+                self.voltages.channel(it),
                 name=f"Voltage ch.{it}",
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
                 #symbol = 'x',
@@ -265,8 +235,8 @@ class PlotPSUWidget(QtWidgets.QMainWindow):
             self.volt_plots.append(volt_line)
             
             curr_line = self.curr_plot_graph.plot(
-                self.time,
-                self.currents[it],
+                self.currents.times(),
+                self.currents.channel(it),
                 name=f"Current ch.{it}",
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
                 #symbol = 'x',
@@ -275,41 +245,130 @@ class PlotPSUWidget(QtWidgets.QMainWindow):
             self.curr_plots.append(curr_line)
 
             power_line = self.power_plot_graph.plot(
-                self.time,
-                self.powers[it],
+                self.powers.times(),
+                self.powers.channel(it),
                 name=f"Power ch.{it}",
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
                 #symbol = 'x',
                 #symbolBrush=colormap(it),
             )
             self.power_plots.append(power_line)
+
+        # Level-of-detail layers: decimated curves for the visible range
+        self.lod_volts = LodPlot(self.volt_plot_graph, self.volt_plots, self.voltages)
+        self.lod_currs = LodPlot(self.curr_plot_graph, self.curr_plots, self.currents)
+        self.lod_pwrs = LodPlot(self.power_plot_graph, self.power_plots, self.powers)
     
     def update_currs_volts_pwrs(self, ts, currs, volts, pwrs):
-        #Discard data older than 2 hours and append time
-        if len(self.time) > 120:
-            self.time = self.time[1:]
-            for channel in range(0, len(currs)):
-                self.currents[channel] = self.currents[channel][1:]
-                self.voltages[channel] = self.voltages[channel][1:]
-                self.powers[channel] = self.powers[channel][1:]
-        self.time.append(ts)
+        #Append the sample: the buffers discard the data older than the plot window
+        self.currents.append(ts, currs)
+        self.voltages.append(ts, volts)
+        self.powers.append(ts, pwrs)
         #Plot currents, voltages and powers
-        for channel in range(0, len(currs)):
-            self.currents[channel].append(currs[channel])
-            self.voltages[channel].append(volts[channel])
-            self.powers[channel].append(pwrs[channel])
-            self.curr_plots[channel].setData(self.time, self.currents[channel])
-            self.volt_plots[channel].setData(self.time, self.voltages[channel])
-            self.power_plots[channel].setData(self.time, self.powers[channel])
+        self.lod_currs.refresh()
+        self.lod_volts.refresh()
+        self.lod_pwrs.refresh()
     
     def update_temps(self, ts, tempsU, tempsY, tempsEXT, tempsP1S):
         pass
 
-def update_measure(psu, widgets, logfile, qlcs_data):
-    ts = timestamp()
-
+class AcquisitionWorker(QtCore.QObject):
+    """
+    Acquire the DAQ970A and PSU data in a dedicated thread, run the heater control,
+    and post the completed samples to the GUI thread through the sample_ready signal.
+    The DAQ970A runs two scan groups: the control sensors every control_period seconds,
+    which only feed the heater control, and the full map every period seconds, which is logged and plotted
+    """
+    sample_ready = QtCore.pyqtSignal(object)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, daq, psu, psu_channels, period, control_period, control):
+        """
+        Parameters
+        ----------
+        daq: qlcsTvacDaq970
+            DAQ970A to read
+        psu: PowerSupply
+            Heaters power supply
+        psu_channels: int
+            Number of PSU channels to read
+        period: float
+            Acquisition period of all the sensors, in seconds
+        control_period: float
+            Acquisition period of the control sensors, in seconds
+        control: function
+            Called as control(psu, ref_UP, ref_p1s) in the worker thread after each acquisition
+        """
+        super().__init__()
+        self.daq = daq
+        self.psu = psu
+        self.psu_channels = psu_channels
+        self.period = period
+        self.control_period = control_period
+        self.control = control
+        self.last_refs = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._control_request = False
+
+    @pyqtSlot()
+    def run(self):
+        self.daq.configScanGroups(self.control_period, self.period)
+        while not self._stop.is_set():
+            if self._control_request and self.last_refs is not None:
+                # Thresholds changed: re-run the control on the last readout
+                self._control_request = False
+                self.control(self.psu, *self.last_refs)
+            group, due = self.daq.nextScanGroup()
+            if time.monotonic() >= due:
+                try:
+                    # The group is rescheduled before the readout: on failure, retry at its next period
+                    values = self.daq.queryGroup(group)
+                    ts = timestamp()
+                    if self.daq.readFormat['time']:
+                        # Instrument time (UTC, set on connection) of the first reading of the scan
+                        ts = self.daq.lastReadings['time'][0]
+                    if self._stop.is_set():
+                        break
+                    self.last_refs = self.daq.controlTemps(group, values)
+                    if group == 'full':
+                        qlcs_data = self.daq.demux(values)
+                        # Resistances before the conversion, in raw mode
+                        raw = self.daq.lastRaw if self.daq.rawMode else None
+                        psu_sample = self.psu.sample(range(1, self.psu_channels+1))
+                        self.control(self.psu, *self.last_refs)
+                        self.sample_ready.emit(dict(ts=ts, daq=qlcs_data, psu=psu_sample, raw=raw))
+                    else:
+                        self.control(self.psu, *self.last_refs)
+                except Exception as e:
+                    # Keep the loop alive, as the timer did
+                    print(f'Acquisition failed: {e}')
+                continue
+            self._wake.wait(max(0, due - time.monotonic()))
+            self._wake.clear()
+        try:
+            self.daq.stop_query()
+        except Exception as e:
+            print(f'Could not stop the DAQ970A: {e}')
+        self.finished.emit()
+
+    def request_control(self):
+        """
+        Re-run the heater control on the last readout, without waiting for the next acquisition
+        """
+        self._control_request = True
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stop the acquisition loop; a readout in progress is completed and discarded
+        """
+        self._stop.set()
+        self._wake.set()
+
+def update_measure(ts, widgets, logfile, qlcs_data, psu_sample):
     # Heaters power supply channels
-    psu_channels = psu.channels
+    psu_channels = len(psu_sample)
 
     # Data from DAQ970A
     tempsU = qlcs_data['u']
@@ -318,35 +377,14 @@ def update_measure(psu, widgets, logfile, qlcs_data):
     tempsP1S = qlcs_data['p1s']
     strain = qlcs_data['strain']
 
-    # Data from power supply
-    currents = []
-    voltages = []
-    powers = []
-    # Acquire values
-    for it in range(psu_channels):
-        currents.append(psu.get_current(it))
-        voltages.append(psu.get_voltage(it))
-        powers.append(psu.compute_power(it))
-
-    # Write to file
-    logfile.write(str(ts))
-    for it in range(len(tempsU)):
-        logfile.write(','+str(tempsU[it]))
-    for it in range(len(tempsY)):
-        logfile.write(','+str(tempsY[it]))
-    for it in range(len(tempsEXT)):
-        logfile.write(','+str(tempsEXT[it]))
-    for it in range(len(tempsP1S)):
-        logfile.write(','+str(tempsP1S[it]))
-    for it in range(len(strain)):
-        logfile.write(','+str(strain[it]))
-    for it in range(psu_channels):
-        logfile.write(','+str(voltages[it]))
-        logfile.write(','+str(currents[it]))
-        logfile.write(','+str(powers[it]))
-
-    logfile.write('\n')
-    logfile.flush()
+    # Data from power supply: one V/I/P sample per channel, taken at the same instant
+    currents = psu_sample['I']
+    voltages = psu_sample['V']
+    powers = psu_sample['P']
+
+    # Write to file: DAQ970A planes, then V, I, P of each PSU channel
+    psu_values = np.column_stack((voltages, currents, powers)).ravel()
+    logfile.row(ts, np.concatenate((tempsU, tempsY, tempsEXT, tempsP1S, strain, psu_values)))
     
     #Update plots
     for widget in widgets:
@@ -354,13 +392,21 @@ def update_measure(psu, widgets, logfile, qlcs_data):
         widget.update_currs_volts_pwrs(ts, currents, voltages, powers)
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, logfile, psu_channels, timestr, alim, daq970a):
+    def __init__(self, logfile, psu_channels, timestr, alim, daq970a, plot_window=7200, control_period=5, rawlogfile=None):
         super().__init__()
         self.setWindowTitle('TEMP PSU')
         self.resize(800, 600)
 
         self.alim = alim
         self.daq970a = daq970a
+        self.logfile = logfile
+        self.rawlogfile = rawlogfile # Resistances of the sensors, in raw mode
+        self.psu_channels = psu_channels
+        self.acq_thread = None
+        self.close_pending = False # Close requested, waiting for the acquisition thread to end
+        self.acq_worker = None
+        self.period = (self.daq970a.timeout+5000)/1000 # Acquisition period, in seconds
+        self.control_period = control_period # Acquisition period of the control sensors, in seconds
         
         self.low_temp_UP = 0.0
         self.high_temp_UP = 0.0
@@ -430,6 +476,8 @@ class MainWindow(QtWidgets.QMainWindow):
         def connect_daq970a(inst_string, usb=False):
             try:
                 self.daq970a.updateConnection(inst_string, usb)
+                # Time-stamp and tag each reading in the instrument
+                self.daq970a.setReadingFormat(time=True, channel=True)
                 daq970_conn_btn.setDisabled(True)
             except pyvisa.errors.VisaIOError:
                 print("Error connecting to the DAQ970A")
@@ -457,22 +505,30 @@ class MainWindow(QtWidgets.QMainWindow):
             self.updateBoxHighP1STemp(high_temp_P1S_box)
 
             write_header(logfile)
-            timer.start()
+
+            # Acquisition worker in its own thread
+            self.acq_thread = QtCore.QThread()
+            self.acq_worker = AcquisitionWorker(self.daq970a, self.alim, psu_channels, self.period, self.control_period, control)
+            self.acq_worker.moveToThread(self.acq_thread)
+            self.acq_thread.started.connect(self.acq_worker.run)
+            self.acq_worker.finished.connect(self.acq_thread.quit)
+            self.acq_worker.sample_ready.connect(self.on_sample)
+            self.acq_thread.finished.connect(lambda: start_btn.setEnabled(True))
+            self.acq_thread.start()
+
             start_btn.setDisabled(True)
+            stop_btn.setEnabled(True)
         
         def stop_query():
-            # Stop timer
-            timer.stop()
-            # Stop DAQ970A
-            self.daq970a.stop_query()
-            # Enable Start button
-            start_btn.setEnabled(True)
+            # Stop the worker: samples still in flight are not logged
+            # The DAQ970A is stopped by the worker, and Start is enabled again when its thread ends
+            self.stop_worker()
             # Disable Stop button
             stop_btn.setDisabled(True) 
 
         # List of all widgets
         widgets = []
-        plot_widget = PlotTempWidget(f"Temp", "Time", "Temp (°C)", 0, self.daq970a)
+        plot_widget = PlotTempWidget(f"Temp", "Time", "Temp (°C)", 0, self.daq970a, plot_window, self.period)
         widgets.append(plot_widget.temp_U_plot_graph)
         plotLayoutUY.addWidget(widgets[0])
         widgets.append(plot_widget.temp_Y_plot_graph)
@@ -483,7 +539,7 @@ class MainWindow(QtWidgets.QMainWindow):
         widgets.append(plot_widget.temp_P1S_plot_graph)
         plotLayoutEP.addWidget(widgets[3])
 
-        plot_widget2 = PlotPSUWidget(f"PSU", "Time", "PSU", 0, self.alim)
+        plot_widget2 = PlotPSUWidget(f"PSU", "Time", "PSU", 0, self.alim, plot_window, self.period)
         widgets.append(plot_widget2.volt_plot_graph)
         plotLayout.addWidget(widgets[4])
         widgets.append(plot_widget2.curr_plot_graph)
@@ -524,25 +580,25 @@ class MainWindow(QtWidgets.QMainWindow):
         low_temp_UP_box = QtWidgets.QLineEdit()
         low_temp_UP_box.setText("-20.0")
         #low_temp_UP_box.setValidator(QDoubleValidator())
-        low_temp_UP_box.editingFinished.connect(lambda: self.updateBoxLowUpTemp(low_temp_UP_box)) #Alternatives: textChanged, returnPressed
+        low_temp_UP_box.editingFinished.connect(lambda: self.updateThreshold(self.updateBoxLowUpTemp, low_temp_UP_box)) #Alternatives: textChanged, returnPressed
         
         high_temp_UP_lbl = QtWidgets.QLabel("High Threshold:")
         #high_temp_UP_lbl.setAlignment(Qt.AlignCenter)
         high_temp_UP_box = QtWidgets.QLineEdit()
         high_temp_UP_box.setText("30.0")
-        high_temp_UP_box.editingFinished.connect(lambda: self.updateBoxHighUpTemp(high_temp_UP_box))
+        high_temp_UP_box.editingFinished.connect(lambda: self.updateThreshold(self.updateBoxHighUpTemp, high_temp_UP_box))
 
         low_temp_P1S_lbl = QtWidgets.QLabel("Low Threshold:")
         #low_temp_P1S_lbl.setAlignment(Qt.AlignCenter)
         low_temp_P1S_box = QtWidgets.QLineEdit()
         low_temp_P1S_box.setText("58.0")
-        low_temp_P1S_box.editingFinished.connect(lambda: self.updateBoxLowP1STemp(low_temp_P1S_box))
+        low_temp_P1S_box.editingFinished.connect(lambda: self.updateThreshold(self.updateBoxLowP1STemp, low_temp_P1S_box))
         
         high_temp_P1S_label = QtWidgets.QLabel("High Threshold")
         #high_temp_P1S_label.setAlignment(Qt.AlignCenter)
         high_temp_P1S_box = QtWidgets.QLineEdit()
         high_temp_P1S_box.setText("60.0")
-        high_temp_P1S_box.editingFinished.connect(lambda: self.updateBoxHighP1STemp(high_temp_P1S_box))
+        high_temp_P1S_box.editingFinished.connect(lambda: self.updateThreshold(self.updateBoxHighP1STemp, high_temp_P1S_box))
         
         # U Plane group box
         upConnBox = QtWidgets.QGroupBox("U Plane Temperature Settings (°C)");
@@ -572,9 +628,6 @@ class MainWindow(QtWidgets.QMainWindow):
         ctrlsLayout.setRowStretch(ctrlsLayout.rowCount(), 1)
         #ctrlsLayout.setColumnStretch(ctrlsLayout.columnCount(), 1)
 
-        timer = QtCore.QTimer()
-        timer.setInterval(self.daq970a.timeout+5000)
-
         self.previous_status = [False, False]
 
         def check_temp(psu, temp, low_temp, high_temp, previous):
@@ -610,35 +663,28 @@ class MainWindow(QtWidgets.QMainWindow):
 
         def write_header(logfile):
             # Write reference temperatures in the header
-            logfile.write('#Initial Reference temperatures: ' + str(self.low_temp_UP) + 'degC < U-Plane < ' + str(self.high_temp_UP) + 'degC, ' + str(self.low_temp_P1S) + 'degC < P1NS < ' + str(self.high_temp_P1S) + 'degC\n')
+            logfile.comment('Initial Reference temperatures: ' + str(self.low_temp_UP) + 'degC < U-Plane < ' + str(self.high_temp_UP) + 'degC, ' + str(self.low_temp_P1S) + 'degC < P1NS < ' + str(self.high_temp_P1S) + 'degC')
 
             #logfile.write('#s')
             #logfile.write(self.daq970a.csvUnits())
             #logfile.write(self.alim.csvUnits())
             #logfile.write('\n')
 
-            logfile.write('Timestamp')
-            logfile.write(self.daq970a.csvHeader())
-            logfile.write(self.alim.csvHeader())
-            logfile.write('\n')
+            logfile.header((self.daq970a.csvHeader() + self.alim.csvHeader()).split(',')[1:])
 
             logfile.flush()
 
-        def timer_callback(psu, widgets, logfile, psu_channels):
-            qlcs_data = self.daq970a.query()
-            
-            update_measure(psu, widgets, logfile, qlcs_data)
-
-            #Compute reference temperatures
-            ref_UP = np.mean([qlcs_data['u'][8], qlcs_data['u'][10]])
-            ref_p1s = np.mean(np.asarray(qlcs_data['p1s']))
+            if self.rawlogfile is not None:
+                self.rawlogfile.header(self.daq970a.rawHeader())
+                self.rawlogfile.flush()
 
+        def control(psu, ref_UP, ref_p1s):
+            # Runs in the acquisition thread, with the reference temperatures of the last readout
             # Check if the temperatures are within the limits and control the heaters for U and P1S
             heater_control(psu, True, ref_UP, self.low_temp_UP, self.high_temp_UP)
             heater_control(psu, False, ref_p1s, self.low_temp_P1S, self.high_temp_P1S)
-        
 
-        timer.timeout.connect(lambda: timer_callback(self.alim, [plot_widget, plot_widget2], logfile, psu_channels))
+        self.plot_widgets = [plot_widget, plot_widget2]
 
         central_widget = QtWidgets.QWidget()
         central_layout = QtWidgets.QVBoxLayout(central_widget)
@@ -646,6 +692,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setCentralWidget(central_widget)
 
     def closeEvent(self, event):
+        if self.close_pending:
+            # Called again when the acquisition thread ended
+            event.accept()
+            return
+
         # Override the closeEvent method to ask the user if they want to exit
         reply = QtWidgets.QMessageBox.question(
             self,
@@ -656,6 +707,16 @@ class MainWindow(QtWidgets.QMainWindow):
         )
 
         if reply == QtWidgets.QMessageBox.Yes:
+            if self.acq_thread is not None and self.acq_thread.isRunning():
+                # The worker stops the DAQ970A once the readout in progress ends:
+                # close the window then, without blocking the GUI thread meanwhile
+                self.stop_worker()
+                self.close_pending = True
+                self.acq_thread.finished.connect(self.close)
+                self.setEnabled(False)
+                print('Closing when the acquisition in progress ends...')
+                event.ignore()
+                return
             self.daq970a.stop_query()
             event.accept()  # Allow the window to close
         else:
@@ -664,6 +725,25 @@ class MainWindow(QtWidgets.QMainWindow):
     def __del__(self):
         del self.alim
         del self.daq970a
+
+    @pyqtSlot(object)
+    def on_sample(self, sample):
+        # Log and plot a sample posted by the acquisition worker
+        update_measure(sample['ts'], self.plot_widgets, self.logfile, sample['daq'], sample['psu'])
+        if self.rawlogfile is not None and sample['raw'] is not None:
+            self.rawlogfile.row(sample['ts'], sample['raw'])
+
+    def stop_worker(self):
+        if self.acq_worker is not None:
+            self.acq_worker.sample_ready.disconnect(self.on_sample)
+            self.acq_worker.stop()
+            self.acq_worker = None
+
+    def updateThreshold(self, update, box):
+        # Apply the new threshold to the heaters without waiting for the next acquisition
+        update(box)
+        if self.acq_worker is not None:
+            self.acq_worker.request_control()
     
     def updateBoxLowUpTemp(self, box):
         try:
@@ -694,23 +774,37 @@ class MainWindow(QtWidgets.QMainWindow):
             box.undo()
 
 def main():
+    parser = argparse.ArgumentParser(description='GUI for the PSU and DAQ970A for the AMS-L0 TVAC tests')
+    parser.add_argument('--format', choices=formats, default='csv', help='Storage of the log: CSV text, or binary records with a JSON schema (default: csv)')
+    parser.add_argument('--raw', action='store_true', help='Read the resistance of the sensors and convert it on the host; the resistances are also logged (temp_plotter_<date>_raw), in the readout order')
+    args, qt_args = parser.parse_known_args()
+
     timestr = time.strftime("%Y%m%d_%H%M%S")
     psu_channels = 4
+    plot_window = 31*24*3600 # Time span of the live plots, in seconds: full resolution, decimated on display
 
     # # Check if the log directory exists
     # if not os.path.exists('log'):
     #     os.makedirs('log')
 
-    with open('log/temp_plotter_' + timestr + '.txt', 'w') as logfile:
+    with contextlib.ExitStack() as stack:
+        logfile = stack.enter_context(openLog('log/temp_plotter_' + timestr, args.format))
         # Write header
-        logfile.write('#DAQ970A and PSU data\n')
-        logfile.write('#Date: ' + timestr + '\n')
+        logfile.comment('DAQ970A and PSU data')
+        logfile.comment('Date: ' + timestr)
+
+        rawlogfile = None
+        if args.raw:
+            rawlogfile = stack.enter_context(openLog('log/temp_plotter_' + timestr + '_raw', args.format))
+            rawlogfile.comment('DAQ970A sensor resistances (ohm), before the conversion')
+            rawlogfile.comment('Date: ' + timestr)
 
         alim = None
         daq970a = qlcsTvacDaq970('', False, timestr)
+        daq970a.setRawMode(args.raw)
                       
-        app = QtWidgets.QApplication(sys.argv)
-        main_window = MainWindow(logfile, psu_channels, timestr, alim, daq970a)
+        app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+        main_window = MainWindow(logfile, psu_channels, timestr, alim, daq970a, plot_window, rawlogfile=rawlogfile)
         main_window.show()
         sys.exit(app.exec())
 
@@ -1,73 +1,398 @@
 """
 Read a log file from the DAQ970A configured for the AMS-L0 TVAC tests and plot the variables. 
+The CSV logs are read in chunks: only the plotted columns are parsed, the rows out of the time window are dropped,
+and the optional resampling is accumulated chunk by chunk, so the memory does not grow with the length of the log.
 """
 
+import os
+import io
 import sys
+import argparse
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from tvacStorage import isBinary, readBinary, seekOffset, LogCache, cacheDir
 
-if(len(sys.argv) != 2):
-  print('Usage:')
-  print('\tTEMP_reader.py <log file (including path)>')
-  sys.exit()
-csvFile = sys.argv[1]
+#Groups of variables: prefix of the columns and unit
+groups = {
+  'strain': ('strain', 'eps'),
+  'temperature': ('pt', 'degC'),
+  'voltage': ('V', 'V'),
+  'current': ('I', 'A'),
+  'power': ('P', 'W')
+}
+aggregations = ('mean', 'min', 'max')
 
-try:
-  rawCsvData = pd.read_csv(csvFile, header=0, parse_dates=True, comment='#')
-except FileNotFoundError:
-    print(f'{csvFile} file not found.')
-    sys.exit()
-except pd.errors.EmptyDataError:
-    print(f'No data in {csvFile}')
-    sys.exit()
-except pd.errors.ParserError:
-    print(f'Parse error in {csvFile}')
-    sys.exit()
-except Exception:
-    print('Error in opening {csvFile}.')
-    print(Exception)
-    sys.exit()
+def parseTime(value: str):
+  """
+  Parse a time limit of the command line: unix time, or date/time as shown in the plots (UTC, e.g. 2024-05-01T12:00)
+  
+  Parameters
+  ----------
+  value : str
+    Time limit
+  
+  Returns
+  -------
+  float
+    Unix time
+  """
+  try:
+    return float(value)
+  except ValueError:
+    return (pd.Timestamp(value) - pd.Timestamp(0)).total_seconds()
 
-#Interpret timestamp as date/time and set it as index
-rawCsvData['Timestamp'] = pd.to_datetime(rawCsvData['Timestamp'],unit='s')
-rawCsvData = rawCsvData.set_index('Timestamp')
-print(rawCsvData.head())
+def groupOf(column: str, selected: list):
+  """
+  Group of a column, among the selected ones
+  
+  Parameters
+  ----------
+  column : str
+    Column name
+  selected : list
+    Selected groups
+  
+  Returns
+  -------
+  str
+    Group of the column; None if the column is not in a selected group
+  """
+  for key in selected:
+    if column.startswith(groups[key][0]):
+      return key
+  return None
 
-#Reorganize dataframe in strains, temperatures, and others
-strains = [col for col in rawCsvData if col.startswith('strain')]
-temperatures = [col for col in rawCsvData if col.startswith('pt')]
-voltages = [col for col in rawCsvData if col.startswith('V')]
-currents = [col for col in rawCsvData if col.startswith('I')]
-powers = [col for col in rawCsvData if col.startswith('P')]
+def reduceChunk(chunk: pd.DataFrame, resample: str, agg: str):
+  """
+  Partial aggregation of a chunk, on the resampling bins: sum and count for the mean, min or max otherwise
+  
+  Parameters
+  ----------
+  chunk : pandas.DataFrame
+    Rows of the chunk, indexed by time
+  resample : str
+    Width of the bins (pandas offset alias, e.g. '10min')
+  agg : str
+    Aggregation: 'mean', 'min' or 'max'
+  
+  Returns
+  -------
+  pandas.DataFrame
+    Partial aggregation, indexed by bin
+  """
+  bins = chunk.groupby(chunk.index.floor(resample))
+  if agg == 'mean':
+    return pd.concat({'sum': bins.sum(), 'count': bins.count()}, axis=1)
+  return bins.agg(agg)
 
-data = {
-  'strain':rawCsvData[strains],
-  'temperature':rawCsvData[temperatures],
-  'voltage':rawCsvData[voltages],
-  'current':rawCsvData[currents],
-  'power':rawCsvData[powers]
-}
+def combine(parts: list, resample: str, agg: str):
+  """
+  Merge the partial aggregations of the chunks: the bins across two chunks are combined exactly
+  
+  Parameters
+  ----------
+  parts : list
+    Partial aggregations (see reduceChunk)
+  resample : str
+    Width of the bins; None if not resampled
+  agg : str
+    Aggregation: 'mean', 'min' or 'max'
+  
+  Returns
+  -------
+  pandas.DataFrame
+    Data, indexed by time
+  """
+  if not parts:
+    return pd.DataFrame()
+  data = pd.concat(parts)
+  if not resample:
+    return data
+  if agg == 'mean':
+    data = data.groupby(level=0).sum()
+    return data['sum'] / data['count'].replace(0, np.nan)
+  return data.groupby(level=0).agg(agg)
 
-#Plots
-for key,df in data.items():
-  try:
+def readLog(logFile: str, selected: list= list(groups), start: float= None, end: float= None, resample: str= None, agg: str= 'mean', chunksize: int= 100000, cache: LogCache= None):
+  """
+  Read the columns of the selected groups of a log, in a time window, optionally resampled
+  
+  Parameters
+  ----------
+  logFile : str
+    CSV log, or one of the files of a binary log (.json, .bin)
+  selected : list, optional
+    Groups of variables to read; default: all
+  start, end : float, optional
+    Time window, unix time; default: the whole log
+  resample : str, optional
+    Width of the resampling bins (pandas offset alias, e.g. '10min'); default: no resampling
+  agg : str, optional
+    Aggregation of the resampling bins: 'mean', 'min' or 'max'; default: 'mean'
+  chunksize : int, optional
+    Rows of the CSV parsed at a time; default: 100000
+  cache : LogCache, optional
+    Cache of the parsed CSV logs; default: parse the CSV at each read
+  
+  Returns
+  -------
+  pandas.DataFrame
+    Data, indexed by time
+  """
+  source = None
+  if isBinary(logFile) or cache:
+    records = readBinary(logFile)[1] if isBinary(logFile) else cache.load(logFile, chunksize)
+    times = np.asarray(records['Timestamp'])
+    first = 0 if start is None else np.searchsorted(times, start)
+    last = len(times) if end is None else np.searchsorted(times, end, side='right')
+    columns = [col for col in records.dtype.names[1:] if groupOf(col, selected)]
+    chunks = (pd.DataFrame({col: records[col][it:it+chunksize] for col in ['Timestamp'] + columns}) for it in range(first, last, chunksize))
+  else:
+    source = open(logFile, 'rb')
+    names = None
+    if start is not None:
+      #Jump to the start of the time window with the time index of the log; the column names are in the header at the top
+      names = pd.read_csv(logFile, comment='#', nrows=0).columns
+      source.seek(seekOffset(logFile, start))
+    chunks = pd.read_csv(source, comment='#', chunksize=chunksize, header=None if names is not None else 0, names=names,
+                         usecols=lambda col: col == 'Timestamp' or groupOf(col, selected) is not None)
+  
+  parts = []
+  for chunk in chunks:
+    #Header lines repeated by a new logging session are not numbers: drop them
+    chunk = chunk.apply(pd.to_numeric, errors='coerce').dropna(subset=['Timestamp'])
+    if end is not None and len(chunk) and chunk['Timestamp'].iloc[0] > end:
+      #The log is in time order: the rest is out of the window
+      break
+    if start is not None:
+      chunk = chunk[chunk['Timestamp'] >= start]
+    if end is not None:
+      chunk = chunk[chunk['Timestamp'] <= end]
+    if chunk.empty:
+      continue
+    #Interpret timestamp as date/time and set it as index
+    chunk = chunk.set_index(pd.to_datetime(chunk.pop('Timestamp'), unit='s'))
+    parts.append(reduceChunk(chunk, resample, agg) if resample else chunk)
+  if source:
+    source.close()
+  return combine(parts, resample, agg)
+
+def plot(data: pd.DataFrame, selected: list= list(groups)):
+  """
+  Plot the selected groups of variables, one figure each
+  
+  Parameters
+  ----------
+  data : pandas.DataFrame
+    Data, indexed by time
+  selected : list, optional
+    Groups of variables to plot; default: all
+  """
+  for key in selected:
+    df = data[[col for col in data if groupOf(col, [key])]]
+    if df.empty:
+      continue
     ax = df.plot()
-  except Exception:
-    print(Exception)
-    exit()
-  ax.grid(True, axis='both', which='both', alpha=0.8, linestyle='dotted')
-  ax.set_title(key+' values')
-  ax.legend(ncols=15 , bbox_to_anchor=(1.1,1.2))
-  if key == 'strain':
-    plt.ylabel('eps')
-  elif key == 'temperature':
-    plt.ylabel('degC')
-  elif key == 'voltage':
-    plt.ylabel('V')
-  elif key == 'current':
-    plt.ylabel('A')
-  elif key == 'power':
-    plt.ylabel('W')
-  plt.tight_layout()
+    ax.grid(True, axis='both', which='both', alpha=0.8, linestyle='dotted')
+    ax.set_title(key+' values')
+    ax.legend(ncols=15 , bbox_to_anchor=(1.1,1.2))
+    plt.ylabel(groups[key][1])
+    plt.tight_layout()
+  plt.show()
+
+class GrowableBuffer:
+  """
+  Time series of several columns, appended in place: the capacity doubles when full, so an append costs as the new rows
+  """
+  def __init__(self, columns: int, capacity: int= 1024):
+    self.size = 0
+    self.times = np.empty(capacity, dtype='datetime64[ns]')
+    self.values = np.empty((capacity, columns))
+  
+  def append(self, times, values):
+    """
+    Append rows: times (datetime64) and values, shape (rows, columns)
+    """
+    needed = self.size + len(times)
+    if needed > len(self.times):
+      capacity = max(needed, 2*len(self.times))
+      self.times = np.resize(self.times, capacity)
+      self.values = np.resize(self.values, (capacity, self.values.shape[1]))
+    self.times[self.size:needed] = times
+    self.values[self.size:needed] = values
+    self.size = needed
+
+class LogFollower:
+  """
+  Follow a CSV log while it is written: each poll parses only the complete lines appended since the previous one;
+  a partial last line is kept until completed. A rotated (replaced) or truncated log is read again from its start.
+  """
+  def __init__(self, logFile: str, selected: list= list(groups), start: float= None):
+    """
+    Parameters
+    ----------
+    logFile : str
+      CSV log
+    selected : list, optional
+      Groups of variables to read; default: all
+    start : float, optional
+      Unix time of the first row; default: from the start of the log
+    """
+    self.logFile = logFile
+    self.selected = selected
+    self.start = start
+    self.names = None
+    self.rotated = False
+    self.file = open(logFile, 'rb')
+    self.pending = b''
+    if start is not None:
+      self.names = list(pd.read_csv(logFile, comment='#', nrows=0).columns)
+      self.file.seek(seekOffset(logFile, start))
+  
+  def _reopen(self):
+    self.file.close()
+    self.file = open(self.logFile, 'rb')
+    self.pending = b''
+    self.names = None
+    self.rotated = True
+  
+  def close(self):
+    self.file.close()
+  
+  def poll(self):
+    """
+    Parse the lines appended since the last poll
+    
+    Returns
+    -------
+    pandas.DataFrame
+      New rows of the selected groups, indexed by time; rotated is set when the log was replaced
+    """
+    self.rotated = False
+    try:
+      stat = os.stat(self.logFile)
+      if stat.st_ino != os.fstat(self.file.fileno()).st_ino or stat.st_size < self.file.tell():
+        self._reopen()
+    except FileNotFoundError:
+      #Rotation in progress: wait for the new log
+      return pd.DataFrame()
+    data = self.pending + self.file.read()
+    cut = data.rfind(b'\n') + 1
+    self.pending = data[cut:]
+    lines = data[:cut]
+    if self.names is None:
+      #Column names from the header, after the comments
+      for line in io.BytesIO(lines):
+        lines = lines[len(line):]
+        if not line.startswith(b'#'):
+          self.names = line.decode().strip().split(',')
+          break
+    if not self.names or not lines:
+      return pd.DataFrame()
+    try:
+      chunk = pd.read_csv(io.BytesIO(lines), comment='#', header=None, names=self.names,
+                          usecols=lambda col: col == 'Timestamp' or groupOf(col, self.selected) is not None)
+    except pd.errors.EmptyDataError:
+      return pd.DataFrame()
+    chunk = chunk.apply(pd.to_numeric, errors='coerce').dropna(subset=['Timestamp'])
+    if self.start is not None:
+      chunk = chunk[chunk['Timestamp'] >= self.start]
+    return chunk.set_index(pd.to_datetime(chunk.pop('Timestamp'), unit='s'))
+
+def follow(logFile: str, selected: list= list(groups), start: float= None, interval: float= 5.):
+  """
+  Plot a log while it is written, until the figures are closed: each update parses and appends only the new rows
+  
+  Parameters
+  ----------
+  logFile : str
+    CSV log
+  selected : list, optional
+    Groups of variables to plot; default: all
+  start : float, optional
+    Unix time of the first row; default: from the start of the log
+  interval : float, optional
+    Time between two updates, in seconds; default: 5
+  """
+  follower = LogFollower(logFile, selected, start)
+  plots = {}
+  plt.ion()
+  while not plots or plt.get_fignums():
+    data = follower.poll()
+    if follower.rotated:
+      print(f'{logFile} rotated: reading the new log')
+      for figure, _, _, _ in plots.values():
+        plt.close(figure)
+      plots = {}
+    for key in selected:
+      columns = [col for col in data if groupOf(col, [key])]
+      if not columns:
+        continue
+      if key not in plots:
+        figure, ax = plt.subplots()
+        lines = [ax.plot([], [], label=col)[0] for col in columns]
+        ax.grid(True, axis='both', which='both', alpha=0.8, linestyle='dotted')
+        ax.set_title(key+' values')
+        ax.set_ylabel(groups[key][1])
+        ax.legend(ncols=15 , bbox_to_anchor=(1.1,1.2))
+        figure.tight_layout()
+        plots[key] = (figure, ax, lines, GrowableBuffer(len(columns)))
+      figure, ax, lines, buffer = plots[key]
+      buffer.append(data.index.to_numpy(), data[columns].to_numpy())
+      for it, line in enumerate(lines):
+        line.set_data(buffer.times[:buffer.size], buffer.values[:buffer.size, it])
+      ax.relim()
+      ax.autoscale_view()
+    plt.pause(interval)
+  follower.close()
+
+def main():
+  parser = argparse.ArgumentParser(description='Plot a log of the AMS-L0 TVAC tests')
+  parser.add_argument('log', help='log file (including path): CSV, or .json/.bin of a binary log')
+  parser.add_argument('--groups', nargs='+', choices=list(groups), default=list(groups), help='variables to plot (default: all)')
+  parser.add_argument('--start', type=parseTime, help='start of the time window: unix time or date/time (UTC)')
+  parser.add_argument('--end', type=parseTime, help='end of the time window: unix time or date/time (UTC)')
+  parser.add_argument('--resample', help='width of the resampling bins, pandas offset alias (e.g. 10min)')
+  parser.add_argument('--agg', choices=aggregations, default='mean', help='aggregation of the resampling bins (default: mean)')
+  parser.add_argument('--chunksize', type=int, default=100000, help='rows parsed at a time (default: 100000)')
+  parser.add_argument('--cache-dir', default=cacheDir, help=f'directory of the cache of the parsed CSV logs (default: {cacheDir})')
+  parser.add_argument('--cache-size', type=float, default=2048, help='maximum size of the cache, in MB (default: 2048)')
+  parser.add_argument('--no-cache', action='store_true', help='parse the CSV log without the cache')
+  parser.add_argument('--follow', action='store_true', help='keep plotting the CSV log while it is written')
+  parser.add_argument('--interval', type=float, default=5., help='time between two updates with --follow, in seconds (default: 5)')
+  args = parser.parse_args()
+  if args.follow:
+    if isBinary(args.log) or args.end is not None or args.resample:
+      parser.error('--follow reads CSV logs, without --end and --resample')
+    try:
+      follow(args.log, args.groups, args.start, args.interval)
+    except FileNotFoundError:
+      print(f'{args.log} file not found.')
+    sys.exit()
+  
+  try:
+    cache = None if args.no_cache else LogCache(args.cache_dir, int(args.cache_size*2**20))
+    data = readLog(args.log, args.groups, args.start, args.end, args.resample, args.agg, args.chunksize, cache)
+  except FileNotFoundError:
+    print(f'{args.log} file not found.')
+    sys.exit()
+  except pd.errors.EmptyDataError:
+    print(f'No data in {args.log}')
+    sys.exit()
+  except pd.errors.ParserError:
+    print(f'Parse error in {args.log}')
+    sys.exit()
+  except Exception as e:
+    print(f'Error in opening {args.log}.')
+    print(e)
+    sys.exit()
+  
+  if data.empty:
+    print(f'No data in {args.log} in the selected time window')
+    sys.exit()
+  print(data.head())
+  plot(data, args.groups)
 
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+  main()
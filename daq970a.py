@@ -2,9 +2,238 @@ import pyvisa
 import re
 import os, sys
 import errno
-from utils import timestamp
+import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import timestamp, BufferedLogWriter
 import numpy as np
 
+#Layout of the readings parsed by daq970a.parseReadings
+#time: unix time of the reading from the instrument clock; chan: channel number; unit: measurement unit
+readingDtype = np.dtype([('value', 'f8'), ('time', 'f8'), ('chan', 'i4'), ('unit', 'U4')])
+
+def parseValues(dataStr: str):
+  """
+  Parse an answer of the instrument with only the reading values (no optional fields),
+  in a single pass of the NumPy C parser, without an intermediate list of strings
+  
+  Parameters
+  ----------
+  dataStr : str
+    Comma-separated answer of the instrument
+  
+  Returns
+  -------
+  numpy.ndarray
+    Reading values
+  """
+  return np.fromstring(dataStr, dtype=float, sep=',')
+
+def parseReadings(dataStr: str, readFormat: dict):
+  """
+  Parse the readings returned by the instrument.
+  Each reading is returned as: value [unit], [year, month, day, hour, minute, second], [channel].
+  The instrument clock is taken as UTC (see daq970a.syncClock).
+  Without units all the fields are numbers, parsed in a single pass by the NumPy C parser
+  (no intermediate list of strings); with units the answer is split in strings first.
+  
+  Parameters
+  ----------
+  dataStr : str
+    Comma-separated answer of the instrument
+  readFormat : dict
+    Optional fields enabled in the instrument: 'time', 'channel', 'unit' (see daq970a.setReadingFormat)
+  
+  Returns
+  -------
+  numpy.ndarray
+    Readings (readingDtype); the fields not enabled are left to 0 (empty for the unit)
+  """
+  nFields = 1 + 6*readFormat['time'] + readFormat['channel']
+  if readFormat['unit']:
+    fields = np.asarray(dataStr.strip().split(',')).reshape(-1, nFields)
+    valUnit = np.char.partition(fields[:, 0], ' ')
+    numbers = np.empty(fields.shape)
+    numbers[:, 0] = valUnit[:, 0].astype(float)
+    numbers[:, 1:] = fields[:, 1:].astype(float)
+  else:
+    numbers = parseValues(dataStr).reshape(-1, nFields)
+  
+  readings = np.zeros(len(numbers), dtype=readingDtype)
+  readings['value'] = numbers[:, 0]
+  if readFormat['unit']:
+    readings['unit'] = valUnit[:, 2]
+  
+  if readFormat['time']:
+    dateTime = numbers[:, 1:7]
+    days = (dateTime[:, 0].astype(int) - 1970).astype('datetime64[Y]')
+    days = days + (dateTime[:, 1].astype(int) - 1).astype('timedelta64[M]')
+    days = days.astype('datetime64[D]') + (dateTime[:, 2].astype(int) - 1).astype('timedelta64[D]')
+    readings['time'] = days.astype('int64')*86400. + dateTime[:, 3]*3600 + dateTime[:, 4]*60 + dateTime[:, 5]
+  
+  if readFormat['channel']:
+    readings['chan'] = numbers[:, -1]
+  
+  return readings
+
+#Callendar-Van Dusen coefficients of the IEC 60751 platinum RTDs
+cvdA = 3.9083e-3
+cvdB = -5.775e-7
+cvdC = -4.183e-12
+
+def cvdTemperature(res, r0= 1000., a= cvdA, b= cvdB, c= cvdC, iterations: int= 4):
+  """
+  Temperature of a platinum RTD from its resistance, inverting the Callendar-Van Dusen equation.
+  Above 0 degC the quadratic is solved in closed form; below, the C term is added by Newton iterations
+  started from the quadratic solution. All the arguments are broadcast, so a whole log converts in one call.
+  
+  Parameters
+  ----------
+  res : numpy.ndarray
+    Resistances, in ohm
+  r0 : float or numpy.ndarray, optional
+    Resistance at 0 degC, in ohm; default: 1000 (PT1000)
+  a, b, c : float or numpy.ndarray, optional
+    Callendar-Van Dusen coefficients; default: IEC 60751
+  iterations : int, optional
+    Newton iterations below 0 degC; default: 4
+  
+  Returns
+  -------
+  numpy.ndarray
+    Temperatures, in degC
+  """
+  ratio = np.asarray(res, dtype=float)/r0
+  temp = (-a + np.sqrt(a*a - 4*b*(1 - ratio)))/(2*b)
+  cold = ratio < 1
+  if np.any(cold):
+    tc = temp
+    for _ in range(iterations):
+      f = 1 + a*tc + b*tc*tc + c*(tc - 100)*tc**3 - ratio
+      df = a + 2*b*tc + c*(4*tc - 300)*tc*tc
+      tc = tc - f/df
+    temp = np.where(cold, tc, temp)
+  return temp
+
+def gaugeStrain(res, r0= 120., gf= 2.):
+  """
+  Strain of a gauge from its resistance
+  
+  Parameters
+  ----------
+  res : numpy.ndarray
+    Resistances, in ohm
+  r0 : float or numpy.ndarray, optional
+    Unstrained resistance, in ohm; default: 120
+  gf : float or numpy.ndarray, optional
+    Gauge factor; default: 2
+  
+  Returns
+  -------
+  numpy.ndarray
+    Strains
+  """
+  return (np.asarray(res, dtype=float)/r0 - 1)/gf
+
+def earliestGroup(scanGroups: dict):
+  """
+  Scan group to scan next: the one with the earliest due time; the shortest period wins the ties
+  
+  Parameters
+  ----------
+  scanGroups : dict
+    Scan groups, with their 'nextDue' and 'period'
+  
+  Returns
+  -------
+  tuple
+    Name of the group and its due time (time.monotonic() reference)
+  """
+  name = min(scanGroups, key=lambda it: (scanGroups[it]['nextDue'], scanGroups[it]['period']))
+  return name, scanGroups[name]['nextDue']
+
+def compilePlanes(planeDict: dict, chMap: list, nameDict: dict):
+  """
+  Compile the layout of the AMS-L0 TVAC readout: position of the sensors of each plane, CSV header and units,
+  sensors of the heater control
+  
+  Parameters
+  ----------
+  planeDict : dict
+    Channels in each type/plane
+  chMap : list
+    Channels in the readout order
+  nameDict : dict
+    Relate the channel to the sensor used
+  
+  Returns
+  -------
+  tuple
+    planeIdx (index array for each plane, or slice when contiguous, so that demux returns views),
+    CSV header and units strings in the order of the planes, control channels (reference of the U plane and P1S) in readout order
+  """
+  position = {ch: it for it,ch in enumerate(chMap)}
+  planeIdx = {}
+  for plane,chList in planeDict.items():
+    idx = np.asarray([position[ch] for ch in chList], dtype=int)
+    if len(idx) and np.all(np.diff(idx) == 1):
+      planeIdx[plane] = slice(int(idx[0]), int(idx[-1])+1)
+    else:
+      planeIdx[plane] = idx
+  
+  headerStr = ''
+  unitsStr = ''
+  for plane,chList in planeDict.items():
+    for ch in chList:
+      headerStr += ','+nameDict[ch]
+      unitsStr += ',eps' if plane == 'strain' else ',degC'
+  
+  controlChannels = sorted([planeDict['u'][8], planeDict['u'][10]] + planeDict['p1s'], key=position.get)
+  return planeIdx, headerStr, unitsStr, controlChannels
+
+def controlReference(planeDict: dict, channels: list, values):
+  """
+  Reference temperatures of the heater control
+  
+  Parameters
+  ----------
+  planeDict : dict
+    Channels in each type/plane
+  channels : list
+    Channels of the readout
+  values : numpy.ndarray
+    Readout
+  
+  Returns
+  -------
+  tuple
+    Mean of the U plane reference sensors and mean of the P1S sensors
+  """
+  readout = dict(zip(channels, values))
+  ref_UP = np.mean([readout[planeDict['u'][8]], readout[planeDict['u'][10]]])
+  ref_p1s = np.mean([readout[ch] for ch in planeDict['p1s']])
+  return ref_UP, ref_p1s
+
+def demuxPlanes(planeIdx: dict, unorderedData):
+  """
+  Order the readings by type of measure and plane
+  
+  Parameters
+  ----------
+  planeIdx : dict
+    Position in the readout of the sensors of each type/plane
+  unorderedData : numpy.ndarray
+    Readings in the readout order, shape (sensors,) or (scans, sensors)
+  
+  Returns
+  -------
+  dict
+    Readings, ordered in a dictionary of arrays, shape (sensors,) or (scans, sensors)
+  """
+  unorderedData = np.asarray(unorderedData)
+  return {plane: unorderedData[..., idx] for plane,idx in planeIdx.items()}
+
 class daq970a:
   """
   Partial wrapper for the low-level interface for the [keysight DAQ970A SCPI commands](https://www.keysight.com/us/en/assets/9018-04756/programming-guides/9018-04756.pdf).
@@ -19,15 +248,31 @@ class daq970a:
     '1': instrument connected with USB, '0': instrument connected with IP address
   resource: Resource
     handle to the instrument, when connection open; None otherwise
-  logger: file
-    handle of the file log
+  logger: BufferedLogWriter
+    handle of the file log, written in batches
   no_err: Pattern[str]
     String returned from the instrument when reading errors and buffer is empty
   timeout: int
     timeout of the instrument, in milliseconds
+  scanList: str
+    channels in the scan list, in SCPI format
+  scanSize: int
+    number of readings in each scan, updated when the streaming starts
+  streaming: bool
+    True while the scanner is armed for the continuous acquisition
+  readFormat: dict
+    Optional fields returned with each reading: 'time', 'channel', 'unit'
+  lastReadings: numpy.ndarray
+    Readings of the last query, with all the enabled fields (readingDtype); None when no optional field is enabled
+  scanGroups: dict
+    Named scan groups read with independent periods (see addScanGroup)
+  currentScan: str
+    Scan list currently set in the instrument; None when unknown
+  rawMode: bool
+    The instrument reads the resistance of the sensors, converted on the host, instead of temperature and strain
   """
   
-  def __init__(self, instr_string: str, usb: bool, timestr: str= ''):
+  def __init__(self, instr_string: str, usb: bool, timestr: str= '', unit: str= ''):
     """
     Parameters
     ----------
@@ -37,18 +282,28 @@ class daq970a:
       '1': instrument connected with USB, '0': instrument connected with IP address
     timestr: str, optional
       Timestamp to append to the log file; default: ''
+    unit: str, optional
+      Name of the unit, appended to the log file to tell apart the units of the same test; default: ''
     """
     self.no_err = re.compile(r'^\+?0')
     self.instr_string = instr_string
     self.usb = usb
     self.resource = None
     self.timeout = 55000 #5 seconds less than the readout period, to have enough time to start a new readout
+    self.scanList = '(@101:120,201:205,207:220,301:309,311:314,315:319)'
+    self.scanSize = 0
+    self.streaming = False
+    self.readFormat = dict(time=False, channel=False, unit=False)
+    self.lastReadings = None
+    self.scanGroups = {}
+    self.currentScan = None
+    self.rawMode = False
     
     self.logger = None
     #Make directory (if not already existing)
     #os.makedirs(os.path.dirname('log'), exist_ok=True)
     try:
-      self.logger = open('log/daq970a_tc_' + timestr + '.txt', 'w')
+      self.logger = BufferedLogWriter('log/daq970a_tc_' + timestr + ('_' + unit if unit else '') + '.txt')
     except OSError:
       print("Could not open log file")
       sys.exit()
@@ -106,6 +361,7 @@ class daq970a:
     if self.resource != None:
       self.reset()
       self.emptyErrorBuffer()
+      self.syncClock()
       print('\n'.join(self.resource.query('*IDN?').split(',')))
       self.log('\n'.join(self.resource.query('*IDN?').split(',')))
   
@@ -154,15 +410,25 @@ class daq970a:
       Instrument unavailable or not connected
     """
     if self.resource:
-      self.resource.write('CONF:TEMP:RTD 1000,(@101:120)')
-      self.resource.write('CONF:TEMP:RTD 1000,(@201:205,207:220)')
-      self.resource.write('CONF:TEMP:RTD 1000,(@315:319)')
-      self.resource.write('CONF:STR:DIR 120,2,(@301:309,311:314)')
-      
-      self.resource.write('TEMP:APER 200E-3')
-      self.resource.write('STR:APER 200E-3')
+      if self.rawMode:
+        #2-wire resistance: the 4-wire mode would pair the channels of the cards, all used by the sensors
+        self.resource.write('CONF:RES 10E+3,(@101:120)')
+        self.resource.write('CONF:RES 10E+3,(@201:205,207:220)')
+        self.resource.write('CONF:RES 10E+3,(@315:319)')
+        self.resource.write('CONF:RES 1E+3,(@301:309,311:314)')
+        
+        self.resource.write('RES:APER 200E-3')
+      else:
+        self.resource.write('CONF:TEMP:RTD 1000,(@101:120)')
+        self.resource.write('CONF:TEMP:RTD 1000,(@201:205,207:220)')
+        self.resource.write('CONF:TEMP:RTD 1000,(@315:319)')
+        self.resource.write('CONF:STR:DIR 120,2,(@301:309,311:314)')
+        
+        self.resource.write('TEMP:APER 200E-3')
+        self.resource.write('STR:APER 200E-3')
 
-      self.resource.write('ROUT:SCAN (@101:120,201:205,207:220,301:309,311:314,315:319)')
+      self.resource.write('ROUT:SCAN '+self.scanList)
+      self.currentScan = self.scanList
       self.resource.write('TRIG:COUN 1')
       
       self.resource.timeout = self.timeout
@@ -171,6 +437,25 @@ class daq970a:
     else:
       raise pyvisa.errors.VisaIOError('DAQ970A not connected')
   
+  def setRawMode(self, raw: bool= True):
+    """
+    Select the readout of the sensors: resistance, converted on the host, or temperature and strain computed by the instrument.
+    The instrument is configured again when connected.
+    
+    Parameters
+    ----------
+    raw : bool, optional
+      Read the resistance of the sensors; default: True
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable
+    """
+    self.rawMode = raw
+    if self.resource:
+      self.config()
+  
   def customCommand(self, cmdStr: str):
     """
     Send a SCPI command to the instrument
@@ -205,12 +490,344 @@ class daq970a:
       Instrument unavailable or not connected
     """
     if self.resource:
-      dataRead = self.resource.query('READ?').split(',')
-      dataRead = np.asarray(dataRead, dtype=float)
-      return dataRead
+      self.selectScan(self.scanList)
+      return self._read()
     else:
       raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def _read(self):
+    """
+    Trigger a scan of the current scan list and parse the answer
+    """
+    dataStr = self.resource.query('READ?')
+    if not any(self.readFormat.values()):
+      self.lastReadings = None
+      return parseValues(dataStr)
+    self.lastReadings = self.parseReadings(dataStr)
+    return self.lastReadings['value']
+  
+  def selectScan(self, scanList: str):
+    """
+    Set the scan list, skipping the command if already set.
+    The configuration of the channels (CONF) is kept when the scan list changes.
+    
+    Parameters
+    ----------
+    scanList : str
+      Channels to scan, in SCPI format
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      if scanList != self.currentScan:
+        self.currentScan = None
+        self.resource.write('ROUT:SCAN '+scanList)
+        self.currentScan = scanList
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def addScanGroup(self, name: str, channels: list, period: float, scanList: str= None):
+    """
+    Define a named group of channels, scanned every period seconds by the scheduler (see schedule)
+    
+    Parameters
+    ----------
+    name : str
+      Name of the group, used to tag the results
+    channels : list of str
+      Channels of the group, in ascending order (the order of the readout)
+    period : float
+      Time between two scans of the group, in seconds
+    scanList : str, optional
+      Same channels, in SCPI format; default: built from channels
+    """
+    self.scanGroups[name] = dict(
+      channels = list(channels),
+      scanList = scanList if scanList else '(@'+','.join(channels)+')',
+      period = period,
+      nextDue = time.monotonic()
+    )
+  
+  def nextScanGroup(self):
+    """
+    Group to scan next: the one with the earliest due time; the shortest period wins the ties
+    
+    Returns
+    -------
+    tuple
+      Name of the group and its due time (time.monotonic() reference)
+    """
+    return earliestGroup(self.scanGroups)
+  
+  def queryGroup(self, name: str):
+    """
+    Scan a group and schedule its next scan
+    
+    Parameters
+    ----------
+    name : str
+      Name of the group
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings of the group, in the order of its channels
     
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    group = self.scanGroups[name]
+    group['nextDue'] = max(group['nextDue'] + group['period'], time.monotonic())
+    self.selectScan(group['scanList'])
+    return self._read()
+  
+  def schedule(self, stop: threading.Event= None):
+    """
+    Generator multiplexing the scan groups on the instrument, each one at its own period
+    
+    Parameters
+    ----------
+    stop : threading.Event, optional
+      Set it to end the generator (also while waiting for the next group); default: run forever
+    
+    Yields
+    ------
+    tuple
+      Name of the group, timestamp and readings of the group
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if stop is None:
+      stop = threading.Event()
+    while not stop.is_set():
+      name, due = self.nextScanGroup()
+      if stop.wait(max(0, due - time.monotonic())):
+        break
+      values = self.queryGroup(name)
+      yield name, timestamp(), values
+  
+  def queryReadings(self):
+    """
+    Read all the data from the instrument, with the optional fields enabled by setReadingFormat
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings (readingDtype), in the scan-list order
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      self.selectScan(self.scanList)
+      self.lastReadings = self.parseReadings(self.resource.query('READ?'))
+      return self.lastReadings
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def setReadingFormat(self, time: bool= True, channel: bool= True, unit: bool= False):
+    """
+    Select the optional fields returned with each reading.
+    The time is the absolute time of the instrument clock, with millisecond resolution.
+    
+    Parameters
+    ----------
+    time : bool, optional
+      Return the time of each reading; default: True
+    channel : bool, optional
+      Return the channel of each reading; default: True
+    unit : bool, optional
+      Return the unit of each reading; default: False
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      onOff = {True: 'ON', False: 'OFF'}
+      self.resource.write('FORM:READ:TIME:TYPE ABS')
+      self.resource.write('FORM:READ:TIME '+onOff[time])
+      self.resource.write('FORM:READ:CHAN '+onOff[channel])
+      self.resource.write('FORM:READ:UNIT '+onOff[unit])
+      self.readFormat = dict(time=time, channel=channel, unit=unit)
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def parseReadings(self, dataStr: str):
+    """
+    Parse the readings returned by the instrument, according to readFormat (see the module function parseReadings)
+    
+    Parameters
+    ----------
+    dataStr : str
+      Comma-separated answer of the instrument
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings (readingDtype); the fields not enabled are left to 0 (empty for the unit)
+    """
+    return parseReadings(dataStr, self.readFormat)
+    
+  def startStream(self, interval: float):
+    """
+    Arm the scanner for the continuous acquisition: one scan every interval seconds, with no scan limit.
+    The readings are accumulated in the reading memory until retrieved with stream or fetchScans.
+    
+    Parameters
+    ----------
+    interval : float
+      Time between the start of two consecutive scans, in seconds
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      self.selectScan(self.scanList)
+      self.scanSize = int(self.resource.query('ROUT:SCAN:SIZE?'))
+      self.resource.write('TRIG:SOUR TIM')
+      self.resource.write(f'TRIG:TIM {interval}')
+      self.resource.write('TRIG:COUN INF')
+      self.resource.write('INIT')
+      self.streaming = True
+      self.log(f'Streaming started: {self.scanSize} readings every {interval} s')
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def stopStream(self):
+    """
+    Stop the continuous acquisition and restore the single-scan trigger used by query.
+    Readings not yet retrieved stay in the reading memory until the next INIT/READ?.
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      self.streaming = False
+      self.stop_query()
+      self.resource.write('TRIG:SOUR IMM')
+      self.resource.write('TRIG:COUN 1')
+      self.log('Streaming stopped')
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def fetchScans(self, scans: int):
+    """
+    Remove complete scans from the reading memory in a single transfer
+    
+    Parameters
+    ----------
+    scans : int
+      Number of scans to retrieve; they must be already available (see DATA:POINts?)
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings, one row per scan, shape (scans, scanSize)
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      if not any(self.readFormat.values()):
+        return parseValues(self.resource.query(f'DATA:REM? {scans*self.scanSize}')).reshape(scans, self.scanSize)
+      return self.fetchReadings(scans)['value']
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def fetchReadings(self, scans: int):
+    """
+    Remove complete scans from the reading memory in a single transfer, with the optional fields enabled by setReadingFormat
+    
+    Parameters
+    ----------
+    scans : int
+      Number of scans to retrieve; they must be already available (see DATA:POINts?)
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings (readingDtype), one row per scan, shape (scans, scanSize)
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      dataRead = self.resource.query(f'DATA:REM? {scans*self.scanSize}')
+      self.lastReadings = self.parseReadings(dataRead).reshape(scans, self.scanSize)
+      return self.lastReadings
+    else:
+      raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+  
+  def stream(self, poll: float= 1., fields: bool= False):
+    """
+    Generator of the scans acquired in the continuous acquisition (see startStream).
+    The complete scans accumulated in the reading memory are retrieved in bulk at each poll;
+    the generator ends when stopStream is called.
+    
+    Parameters
+    ----------
+    poll : float, optional
+      Time between two checks of the reading memory, in seconds; default: 1
+    fields : bool, optional
+      Yield the readings with the optional fields (readingDtype) instead of the values only; default: False
+    
+    Yields
+    ------
+    numpy.ndarray
+      Readings of one scan, in the scan-list order
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    while self.streaming:
+      if not self.resource:
+        raise pyvisa.errors.VisaIOError('DAQ970A not connected')
+      scans = int(self.resource.query('DATA:POIN?')) // self.scanSize
+      if scans:
+        for scan in (self.fetchReadings(scans) if fields else self.fetchScans(scans)):
+          yield scan
+      else:
+        time.sleep(poll)
+  
+  @staticmethod
+  def scanOffsets(readings):
+    """
+    Time of each reading from the start of its scan
+    
+    Parameters
+    ----------
+    readings : numpy.ndarray
+      Readings with the time field (readingDtype), shape (scanSize,) or (scans, scanSize)
+    
+    Returns
+    -------
+    numpy.ndarray
+      Time offsets, in seconds, same shape as readings
+    """
+    return readings['time'] - readings['time'][..., :1]
+  
   def customQuery(self, queryStr: str):
     """
     Read a generic data from the instrument
@@ -242,6 +859,15 @@ class daq970a:
     """
     self.resource.write('ABOR')
 
+  def syncClock(self):
+    """
+    Set the instrument clock to the UTC time of the host: the reading timestamps are parsed as UTC,
+    so they do not jump at the daylight saving time changes
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    self.resource.write(f'SYST:DATE {now.year},{now.month},{now.day}')
+    self.resource.write(f'SYST:TIME {now.hour},{now.minute},{now.second + now.microsecond*1e-6:.3f}')
+  
   def reset(self):
     """
     Abort the query in progress and reset the instrument
@@ -267,7 +893,6 @@ class daq970a:
     """
     ts = timestamp()
     self.logger.write(str(ts)+','+txt+'\n')
-    self.logger.flush()
 
 
 class qlcsTvacDaq970(daq970a):
@@ -282,12 +907,18 @@ class qlcsTvacDaq970(daq970a):
     '1': instrument connected with USB, '0': instrument connected with IP address
   resource: Resource
     handle to the instrument, when connection open; None otherwise
-  logger: file
-    handle of the file log
+  logger: BufferedLogWriter
+    handle of the file log, written in batches
   no_err: Pattern[str]
     String returned from the instrument when reading errors and buffer is empty
   timeout: int
     timeout of the instrument, in milliseconds
+  scanList: str
+    channels in the scan list, in SCPI format
+  scanSize: int
+    number of readings in each scan, updated when the streaming starts
+  streaming: bool
+    True while the scanner is armed for the continuous acquisition
   chDict: dict
     Relates each channel to the type of measure and plane
   map: list
@@ -298,9 +929,17 @@ class qlcsTvacDaq970(daq970a):
     Number of sensors used for each type of measure/plane
   planeDict: dict
     Sensors in each type/plane, in the same order of the readout
+  planeIdx: dict
+    Position in the readout of the sensors of each type/plane: index array, or slice when contiguous
+  controlChannels: list
+    Channels read by the heater control (U plane reference and P1S)
+  calibDict: dict
+    Conversion coefficients of each sensor, by name: R0, A, B, C for the RTDs, R0, GF for the strain gauges
+  lastRaw: numpy.ndarray
+    Resistances of the last readout, before the conversion, in the readout order; None out of raw mode
   """
   
-  def __init__(self, instr_string: str, usb: bool, timestr: str= ''):
+  def __init__(self, instr_string: str, usb: bool, timestr: str= '', unit: str= ''):
     """
     Initializes the super class and defines the specific attributes
     
@@ -312,8 +951,11 @@ class qlcsTvacDaq970(daq970a):
       '1': instrument connected with USB, '0': instrument connected with IP address
     timestr: str, optional
       Timestamp to append to the log file; default: ''
+    unit: str, optional
+      Name of the unit, appended to the log file to tell apart the units of the same test; default: ''
     """
-    super().__init__(instr_string, usb, timestr)
+    super().__init__(instr_string, usb, timestr, unit)
+    self.lastRaw = None
     self.connectionDefinition()
   
   def connectionDefinition(self):
@@ -454,6 +1096,65 @@ class qlcsTvacDaq970(daq970a):
     for name,val in self.chDict.items():
       self.lenDict[val] += 1
       self.planeDict[val].append(name)
+    
+    #Compile the map once: position of the sensors of each plane, CSV header and units, sensors of the heater control
+    self.planeIdx, self.headerStr, self.unitsStr, self.controlChannels = compilePlanes(self.planeDict, self.map, self.nameDict)
+    
+    #Nominal coefficients of the sensors: PT1000 and 120 ohm gauges; edit calibDict and call compileCalibration
+    self.calibDict = {}
+    for ch,name in self.nameDict.items():
+      if self.chDict[ch] == 'strain':
+        self.calibDict[name] = dict(R0=120., GF=2.)
+      else:
+        self.calibDict[name] = dict(R0=1000., A=cvdA, B=cvdB, C=cvdC)
+    self.compileCalibration()
+  
+  def compileCalibration(self):
+    """
+    Arrange the coefficients of calibDict in arrays, in the readout order, for the vectorized conversion
+    """
+    names = [self.nameDict[ch] for ch in self.map]
+    self.isStrain = np.asarray([self.chDict[ch] == 'strain' for ch in self.map])
+    self.calR0 = np.asarray([self.calibDict[name]['R0'] for name in names], dtype=float)
+    self.calA = np.asarray([self.calibDict[name].get('A', cvdA) for name in names], dtype=float)
+    self.calB = np.asarray([self.calibDict[name].get('B', cvdB) for name in names], dtype=float)
+    self.calC = np.asarray([self.calibDict[name].get('C', cvdC) for name in names], dtype=float)
+    self.calGF = np.asarray([self.calibDict[name].get('GF', 1.) for name in names], dtype=float)
+  
+  def convert(self, resistances, channels: list= None):
+    """
+    Convert the resistances of the sensors to temperature and strain, with the coefficients of each sensor.
+    Works on a single scan or on a whole log, shape (..., sensors).
+    
+    Parameters
+    ----------
+    resistances : numpy.ndarray
+      Resistances, in ohm, in the readout order
+    channels : list of str, optional
+      Channels of the readout (e.g. of a scan group); default: the whole map
+    
+    Returns
+    -------
+    numpy.ndarray
+      Temperatures (degC) and strains, same shape as resistances
+    """
+    idx = slice(None) if channels is None else [self.map.index(ch) for ch in channels]
+    res = np.asarray(resistances, dtype=float)
+    with np.errstate(invalid='ignore'):
+      temps = cvdTemperature(res, self.calR0[idx], self.calA[idx], self.calB[idx], self.calC[idx])
+    strains = gaugeStrain(res, self.calR0[idx], self.calGF[idx])
+    return np.where(self.isStrain[idx], strains, temps)
+  
+  def rawHeader(self):
+    """
+    Names of the sensors in the readout order, for the log of the resistances (lastRaw), that convert takes as they are
+    
+    Returns
+    -------
+    list of str
+      Sensor names
+    """
+    return [self.nameDict[ch] for ch in self.map]
 
   def csvHeader(self):
     """
@@ -464,18 +1165,7 @@ class qlcsTvacDaq970(daq970a):
     str
       Header string of the CSV file
     """
-    retStr = ''
-    for it in range(self.lenDict['u']):
-      retStr += ','+self.nameDict[self.planeDict['u'][it]]
-    for it in range(self.lenDict['y']):
-      retStr += ','+self.nameDict[self.planeDict['y'][it]]
-    for it in range(self.lenDict['ext']):
-      retStr += ','+self.nameDict[self.planeDict['ext'][it]]
-    for it in range(self.lenDict['p1s']):
-      retStr += ','+self.nameDict[self.planeDict['p1s'][it]]
-    for it in range(self.lenDict['strain']):
-      retStr += ','+self.nameDict[self.planeDict['strain'][it]]
-    return retStr
+    return self.headerStr
   
   def csvUnits(self):
     """
@@ -484,15 +1174,9 @@ class qlcsTvacDaq970(daq970a):
     Returns
     -------
     str
-      String of the units of the measurements, ordered as read from the instrument
+      String of the units of the measurements, in the same order of the header
     """
-    unitStr = ''
-    for idx,val in enumerate(self.map):
-      if self.chDict[str(val)] == 'strain':
-        unitStr += ',eps'
-      else:
-        unitStr += ',degC'
-    return unitStr
+    return self.unitsStr
     
   def query(self):
     """
@@ -507,11 +1191,480 @@ class qlcsTvacDaq970(daq970a):
     ------
     Generic exceptions
     """
-    retDict = dict(u=[], y=[], ext=[], p1s=[], strain=[])
     try:
-      unorderedData = super().query()
-      for idx,val in enumerate(unorderedData):
-        retDict[self.chDict[str(self.map[idx])]].append(val)
-      return retDict
+      return self.demux(self.queryValues())
     except:
-      raise
\ No newline at end of file
+      raise
+  
+  def queryValues(self):
+    """
+    Read all the measurements, in the readout order (converted in raw mode)
+    
+    Returns
+    -------
+    numpy.ndarray
+      Instrument readout
+    """
+    values = super().query()
+    if self.rawMode:
+      self.lastRaw = values
+      values = self.convert(values)
+    return values
+  
+  def stream(self, poll: float= 1.):
+    """
+    Overloading stream function to order the measurements of each scan as needed
+    
+    Parameters
+    ----------
+    poll : float, optional
+      Time between two checks of the reading memory, in seconds; default: 1
+    
+    Yields
+    ------
+    dict
+      Readout of one scan, ordered in a dictionary
+    """
+    for scan in super().stream(poll):
+      if self.rawMode:
+        self.lastRaw = scan
+        scan = self.convert(scan)
+      yield self.demux(scan)
+  
+  def queryGroup(self, name: str):
+    """
+    Overloading queryGroup function to convert the resistances in raw mode (kept in lastRaw)
+    
+    Parameters
+    ----------
+    name : str
+      Name of the group
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings of the group, in the order of its channels
+    """
+    values = super().queryGroup(name)
+    if self.rawMode:
+      self.lastRaw = values
+      values = self.convert(values, self.scanGroups[name]['channels'])
+    return values
+  
+  def configScanGroups(self, controlPeriod: float, fullPeriod: float):
+    """
+    Define the two scan groups of the test: the control sensors, read at a fast rate, and the full map
+    
+    Parameters
+    ----------
+    controlPeriod : float
+      Time between two scans of the control sensors, in seconds
+    fullPeriod : float
+      Time between two scans of all the sensors, in seconds
+    """
+    self.scanGroups = {}
+    self.addScanGroup('control', self.controlChannels, controlPeriod)
+    self.addScanGroup('full', self.map, fullPeriod, self.scanList)
+  
+  def controlTemps(self, name: str, values):
+    """
+    Extract the reference temperatures of the heater control from the readout of a scan group
+    
+    Parameters
+    ----------
+    name : str
+      Name of the scan group
+    values : numpy.ndarray
+      Readout of the scan group
+    
+    Returns
+    -------
+    tuple
+      Mean of the U plane reference sensors and mean of the P1S sensors
+    """
+    return controlReference(self.planeDict, self.scanGroups[name]['channels'], values)
+  
+  def demux(self, unorderedData):
+    """
+    Order the readings by type of measure and plane
+    
+    Parameters
+    ----------
+    unorderedData : numpy.ndarray
+      Readings in the scan-list order: a single scan, shape (scanSize,), or several scans, shape (scans, scanSize)
+    
+    Returns
+    -------
+    dict
+      Readings, ordered in a dictionary of arrays, shape (sensors,) or (scans, sensors)
+    """
+    return demuxPlanes(self.planeIdx, unorderedData)
+
+class qlcsTvacDaqArray:
+  """
+  Several qlcsTvacDaq970 mainframes read as a single instrument: the units are scanned concurrently,
+  one thread per VISA session, so that a readout lasts as long as the slowest unit, not the sum of all of them.
+  Exposes the readout interface of qlcsTvacDaq970 (query, scan groups, demux, CSV header and units).
+  
+  The channels are prefixed by the position of their unit ('0.101', '1.101', ...); the sensors keep their names,
+  with the unit position appended when the same name is used in more units.
+  The readings are merged in the unit order: within each plane, the header is the concatenation of the unit headers.
+  
+  Attributes
+  ----------
+  units: list
+    qlcsTvacDaq970 instances, connected
+  executor: ThreadPoolExecutor
+    One thread for each unit
+  map: list
+    Channels of all the units, in the merged readout order
+  nameDict: dict
+    Relate the channel to the sensor used
+  lenDict: dict
+    Number of sensors used for each type of measure/plane
+  planeDict: dict
+    Sensors in each type/plane, in the same order of the readout
+  planeIdx: dict
+    Position in the merged readout of the sensors of each type/plane
+  controlChannels: list
+    Channels read by the heater control (U plane reference and P1S of all the units)
+  scanGroups: dict
+    Named scan groups read with independent periods (see addScanGroup)
+  lastReadings: numpy.ndarray
+    Readings of the last query of the units, with all the enabled fields (readingDtype); None when no optional field is enabled
+  lastSkew: float
+    Spread of the instrument time of the first reading of each unit in the last query, in seconds; 0 without the time field
+  lastRaw: numpy.ndarray
+    Resistances of the last query of the units, before the conversion; None out of raw mode
+  """
+  
+  def __init__(self, units: list):
+    """
+    Parameters
+    ----------
+    units: list
+      qlcsTvacDaq970 instances, connected, each with its own log (see fromInstruments)
+    
+    Raises
+    ------
+    ValueError
+      Two units write the same log file
+    """
+    self.units = list(units)
+    logs = [unit.logger.path for unit in self.units if unit.logger is not None]
+    if len(set(logs)) != len(logs):
+      raise ValueError('The units write the same log file: create them with different unit names')
+    self.executor = ThreadPoolExecutor(max_workers=len(self.units))
+    self.scanGroups = {}
+    self.lastReadings = None
+    self.lastSkew = 0.
+    self.lastRaw = None
+    
+    #Unit and channel of each prefixed channel, in the merged readout order
+    self.unitChannels = {f'{k}.{ch}': (k, ch) for k,unit in enumerate(self.units) for ch in unit.map}
+    self.map = list(self.unitChannels)
+    
+    names = [self.units[k].nameDict[ch] for k,ch in self.unitChannels.values()]
+    self.nameDict = {}
+    for tag,(k,ch) in self.unitChannels.items():
+      name = self.units[k].nameDict[ch]
+      self.nameDict[tag] = name if names.count(name) == 1 else f'{name}_{k}'
+    
+    self.planeDict = {}
+    self.lenDict = {}
+    for plane in self.units[0].planeDict:
+      self.planeDict[plane] = [f'{k}.{ch}' for k,unit in enumerate(self.units) for ch in unit.planeDict[plane]]
+      self.lenDict[plane] = len(self.planeDict[plane])
+    self.planeIdx, self.headerStr, self.unitsStr, self.controlChannels = compilePlanes(self.planeDict, self.map, self.nameDict)
+  
+  @classmethod
+  def fromInstruments(cls, instrStrings: list, usb: bool, timestr: str= ''):
+    """
+    Create the units and the array; the log of each unit has the position of the unit appended
+    
+    Parameters
+    ----------
+    instrStrings: list of str
+      USB names or IP addresses of the instruments
+    usb: bool
+      '1': instruments connected with USB, '0': instruments connected with IP address
+    timestr: str, optional
+      Timestamp to append to the log files; default: ''
+    
+    Returns
+    -------
+    qlcsTvacDaqArray
+      Array of the units
+    """
+    return cls([qlcsTvacDaq970(instr, usb, timestr, str(k)) for k,instr in enumerate(instrStrings)])
+  
+  @property
+  def timeout(self):
+    """
+    Timeout of the slowest unit, in milliseconds
+    """
+    return max(unit.timeout for unit in self.units)
+  
+  @property
+  def readFormat(self):
+    """
+    Optional fields enabled in the units (see setReadingFormat)
+    """
+    return self.units[0].readFormat
+  
+  @property
+  def rawMode(self):
+    """
+    True when the units read the resistance of the sensors (see setRawMode)
+    """
+    return self.units[0].rawMode
+  
+  def setRawMode(self, raw: bool= True):
+    """
+    Select the readout of the sensors in all the units: resistance, converted on the host, or temperature and strain
+    
+    Parameters
+    ----------
+    raw : bool, optional
+      Read the resistance of the sensors; default: True
+    """
+    for daq in self.units:
+      daq.setRawMode(raw)
+  
+  def rawHeader(self):
+    """
+    Names of the sensors in the merged readout order, for the log of the resistances (lastRaw)
+    
+    Returns
+    -------
+    list of str
+      Sensor names
+    """
+    return [self.nameDict[tag] for tag in self.map]
+  
+  def setReadingFormat(self, time: bool= True, channel: bool= True, unit: bool= False):
+    """
+    Select the optional fields returned with each reading, in all the units
+    
+    Parameters
+    ----------
+    time : bool, optional
+      Add the instrument time of each reading; default: True
+    channel : bool, optional
+      Add the channel of each reading; default: True
+    unit : bool, optional
+      Add the measurement unit of each reading; default: False
+    """
+    for daq in self.units:
+      daq.setReadingFormat(time, channel, unit)
+  
+  def csvHeader(self):
+    """
+    Write the header to the CSV file to match the log lines that will come after
+    
+    Returns
+    -------
+    str
+      Header string of the CSV file
+    """
+    return self.headerStr
+  
+  def csvUnits(self):
+    """
+    Define the units of each measurement
+    
+    Returns
+    -------
+    str
+      String of the units of the measurements, in the same order of the header
+    """
+    return self.unitsStr
+  
+  def _gather(self, units: list, function):
+    """
+    Run the same readout on several units at the same time and merge the results in the unit order
+    
+    Parameters
+    ----------
+    units : list
+      Units to read
+    function : function
+      Readout, called as function(unit) in the thread of each unit
+    
+    Returns
+    -------
+    numpy.ndarray
+      Merged readings
+    """
+    futures = [self.executor.submit(function, unit) for unit in units]
+    values = np.concatenate([future.result() for future in futures])
+    readings = [unit.lastReadings for unit in units]
+    if all(it is not None for it in readings):
+      self.lastReadings = np.concatenate(readings)
+      starts = [it['time'][0] for it in readings if len(it)]
+      self.lastSkew = max(starts) - min(starts) if self.readFormat['time'] and starts else 0.
+    else:
+      self.lastReadings = None
+      self.lastSkew = 0.
+    raws = [unit.lastRaw for unit in units]
+    self.lastRaw = np.concatenate(raws) if self.rawMode and all(it is not None for it in raws) else None
+    return values
+  
+  def query(self):
+    """
+    Read all the units at the same time and order the measurements
+    
+    Returns
+    -------
+    dict
+      Readout of all the units, ordered in a dictionary
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      One of the units unavailable or not connected
+    """
+    return self.demux(self._gather(self.units, lambda unit: unit.queryValues()))
+  
+  def byName(self, values):
+    """
+    Relate the readings of all the units to the names of the sensors
+    
+    Parameters
+    ----------
+    values : numpy.ndarray
+      Readings in the merged readout order, shape (..., sensors)
+    
+    Returns
+    -------
+    dict
+      Readings of each sensor
+    """
+    values = np.asarray(values)
+    return {self.nameDict[tag]: values[..., it] for it,tag in enumerate(self.map)}
+  
+  def addScanGroup(self, name: str, channels: list, period: float):
+    """
+    Define a named group of channels, spread over the units, scanned every period seconds
+    
+    Parameters
+    ----------
+    name : str
+      Name of the group, used to tag the results
+    channels : list of str
+      Prefixed channels of the group, in the merged readout order
+    period : float
+      Time between two scans of the group, in seconds
+    """
+    units = []
+    for k,unit in enumerate(self.units):
+      chList = [self.unitChannels[tag][1] for tag in channels if self.unitChannels[tag][0] == k]
+      if chList:
+        unit.addScanGroup(name, chList, period, unit.scanList if chList == unit.map else None)
+        units.append(unit)
+    self.scanGroups[name] = dict(
+      channels = list(channels),
+      units = units,
+      period = period,
+      nextDue = time.monotonic()
+    )
+  
+  def configScanGroups(self, controlPeriod: float, fullPeriod: float):
+    """
+    Define the two scan groups of the test: the control sensors, read at a fast rate, and all the sensors
+    
+    Parameters
+    ----------
+    controlPeriod : float
+      Time between two scans of the control sensors, in seconds
+    fullPeriod : float
+      Time between two scans of all the sensors, in seconds
+    """
+    self.scanGroups = {}
+    for unit in self.units:
+      unit.scanGroups = {}
+    self.addScanGroup('control', self.controlChannels, controlPeriod)
+    self.addScanGroup('full', self.map, fullPeriod)
+  
+  def nextScanGroup(self):
+    """
+    Group to scan next: the one with the earliest due time; the shortest period wins the ties
+    
+    Returns
+    -------
+    tuple
+      Name of the group and its due time (time.monotonic() reference)
+    """
+    return earliestGroup(self.scanGroups)
+  
+  def queryGroup(self, name: str):
+    """
+    Scan a group on its units at the same time and schedule its next scan
+    
+    Parameters
+    ----------
+    name : str
+      Name of the group
+    
+    Returns
+    -------
+    numpy.ndarray
+      Readings of the group, in the order of its channels
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      One of the units unavailable or not connected
+    """
+    group = self.scanGroups[name]
+    group['nextDue'] = max(group['nextDue'] + group['period'], time.monotonic())
+    return self._gather(group['units'], lambda unit: unit.queryGroup(name))
+  
+  def controlTemps(self, name: str, values):
+    """
+    Extract the reference temperatures of the heater control from the readout of a scan group
+    
+    Parameters
+    ----------
+    name : str
+      Name of the scan group
+    values : numpy.ndarray
+      Readout of the scan group
+    
+    Returns
+    -------
+    tuple
+      Mean of the U plane reference sensors and mean of the P1S sensors
+    """
+    return controlReference(self.planeDict, self.scanGroups[name]['channels'], values)
+  
+  def demux(self, unorderedData):
+    """
+    Order the readings of all the units by type of measure and plane
+    
+    Parameters
+    ----------
+    unorderedData : numpy.ndarray
+      Readings in the merged readout order, shape (sensors,) or (scans, sensors)
+    
+    Returns
+    -------
+    dict
+      Readings, ordered in a dictionary of arrays, shape (sensors,) or (scans, sensors)
+    """
+    return demuxPlanes(self.planeIdx, unorderedData)
+  
+  def stop_query(self):
+    """
+    Abort the queries in progress in all the units
+    """
+    for unit in self.units:
+      unit.stop_query()
+  
+  def close(self):
+    """
+    Stop the threads and close the connection to all the units
+    """
+    self.executor.shutdown(wait=True)
+    for unit in self.units:
+      unit.close()
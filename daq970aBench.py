@@ -0,0 +1,53 @@
+"""
+Microbenchmark of the parsing of the DAQ970A ASCII answers (READ?, DATA:REMove?).
+Compare the str.split parsing used before with the single-pass parsers of daq970a (parseValues, parseReadings),
+for a single 60-channel scan and for a 100k-reading block from the reading memory.
+No instrument needed: the answers are generated with the instrument number format.
+"""
+
+import timeit
+import numpy as np
+from daq970a import parseValues, parseReadings
+
+def makePayload(readings: int, timeFields: bool):
+  """
+  Answer of the instrument with the given number of readings, with or without time and channel fields
+  """
+  values = ['%+.9E' % v for v in np.random.default_rng(0).uniform(-50, 50, readings)]
+  if timeFields:
+    values = [v + ',2026,10,18,12,30,%06.3f,%d' % ((it*0.2) % 60, 101 + it % 60) for it,v in enumerate(values)]
+  return ','.join(values) + '\n'
+
+def splitValues(dataStr: str):
+  """
+  Previous parsing of READ?: list of strings, then conversion
+  """
+  return np.asarray(dataStr.split(','), dtype=float)
+
+def splitFields(dataStr: str):
+  """
+  Previous parsing of the readings with time and channel fields: array of strings, then conversion
+  """
+  return np.asarray(dataStr.strip().split(',')).reshape(-1, 8).astype(float)
+
+def bench(func, arg, repeat: int= 5):
+  """
+  Best time of a call, in seconds
+  """
+  number = max(1, int(2e5 // len(arg)))
+  return min(timeit.repeat(lambda: func(arg), number=number, repeat=repeat)) / number
+
+if __name__ == '__main__':
+  tagged = dict(time=True, channel=True, unit=False)
+  print(f'{"readings":>9} {"fields":>13} {"split [ms]":>11} {"daq970a [ms]":>13} {"speed-up":>9}')
+  for readings in [60, 100000]:
+    for timeFields in [False, True]:
+      payload = makePayload(readings, timeFields)
+      if timeFields:
+        tSplit = bench(splitFields, payload)
+        tNew = bench(lambda s: parseReadings(s, tagged), payload)
+      else:
+        tSplit = bench(splitValues, payload)
+        tNew = bench(parseValues, payload)
+      label = 'time+channel' if timeFields else 'value'
+      print(f'{readings:>9} {label:>13} {tSplit*1e3:>11.3f} {tNew*1e3:>13.3f} {tSplit/tNew:>8.1f}x')
@@ -1,6 +1,60 @@
 from lecroydso import LeCroyDSO, LeCroyVISA
 from lecroydso.errors import DSOConnectionError, DSOIOError
-from time import sleep
+from time import sleep, monotonic
+from contextlib import nullcontext
+import numpy as np
+
+#VBS paths of the measurement fields read by read_measurements, relative to app.Measure.Px
+measureFields = {
+  'value': 'Out.Result.Value',
+  'mean': 'mean.Result.Value',
+  'sdev': 'sdev.Result.Value',
+  'min': 'min.Result.Value',
+  'max': 'max.Result.Value',
+  'num': 'num.Result.Value',
+  'status': 'mean.Result.Status',
+  'equation': 'Equation',
+}
+#Fields of read_measurements returned as text instead of float
+measureTextFields = ('equation',)
+
+def parseWaveDesc(block:bytes):
+  """
+  Scale a waveform in the LeCroy binary format (WAVEDESC descriptor followed by the data)
+  
+  Parameters
+  ----------
+  block : bytes
+    Waveform, as returned by WF? or saved in a .trc file (without the #9 header)
+  
+  Returns
+  -------
+  tuple of numpy.ndarray
+    Time (s) and voltage (V) of each point, float32
+  
+  Raises
+  ------
+  DSOIOError
+    Not a LeCroy waveform
+  """
+  start = bytes(block[:64]).find(b'WAVEDESC')
+  if start < 0:
+    raise DSOIOError('WAVEDESC not found in the waveform')
+  desc = memoryview(block)[start:]
+  #COMM_ORDER: 0 = big endian (HIFIRST), 1 = little endian (LOFIRST); its low byte tells the order of the whole block
+  order = '<' if desc[34] else '>'
+  word = np.frombuffer(desc, dtype=order+'i2', count=1, offset=32)[0] == 1 #COMM_TYPE: 0 = byte, 1 = word
+  lengths = np.frombuffer(desc, dtype=order+'i4', count=7, offset=36)
+  waveDescriptor, userText, _, trigTime, risTime, _, waveArray1 = lengths
+  gain, offset = np.frombuffer(desc, dtype=order+'f4', count=2, offset=156)
+  interval = np.frombuffer(desc, dtype=order+'f4', count=1, offset=176)[0]
+  horizOffset = np.frombuffer(desc, dtype=order+'f8', count=1, offset=180)[0]
+  
+  dataStart = waveDescriptor + userText + trigTime + risTime
+  raw = np.frombuffer(desc, dtype=order+('i2' if word else 'i1'), count=waveArray1//(2 if word else 1), offset=dataStart)
+  volts = (raw*np.float32(gain) - np.float32(offset)).astype(np.float32)
+  times = (horizOffset + np.arange(len(raw))*np.float64(interval)).astype(np.float32)
+  return times, volts
 
 class dsoClass:
   """
@@ -83,7 +137,55 @@ class dsoClass:
       Number of acquired sweeps
     """
     
-    return int(self.dso.query_vbs('app.Acquisition.'+channel+'.Out.Result.Sweeps'))
+    return int(self.dso.query_vbs('app.Acquisition.'+str(channel)+'.Out.Result.Sweeps'))
+  
+  def clear_sweeps(self):
+    """
+    Clear the acquired sweeps and the measurement statistics
+    """
+    self.dso.clear_sweeps()
+  
+  def wait_for_sweeps(self, target:int, timeout:float = 60, poll_interval:float = 0.1, channel = None, first:int = 1, last:int = 8, lock = None):
+    """
+    Wait until the oscilloscope has acquired a number of sweeps.
+    The polling interval doubles at each poll that does not reach the target, up to 2 s.
+    
+    Parameters
+    ----------
+    target : int
+      Number of sweeps to reach
+    timeout : float
+      Maximum waiting time (s)
+    poll_interval : float
+      Initial polling interval (s)
+    channel : str
+      DSO channel (C1..C4) whose averaged sweeps are counted.
+      If None, count the lowest number of sweeps of the measurements
+    first : int
+      first measurement to check (1 to 8), if channel is None
+    last : int
+      last measurement to check (1 to 8), if channel is None
+    lock : threading.Lock
+      Held during each poll only, to share the connection with other threads
+
+    Returns
+    -------
+    int
+      Number of acquired sweeps: lower than target on timeout
+    """
+    lock = lock or nullcontext()
+    deadline = monotonic() + timeout
+    while True:
+      with lock:
+        if channel is None:
+          sweeps = self.readMinSweep(first, last)
+        else:
+          sweeps = self.read_acquired_sweeps(channel)
+      remaining = deadline - monotonic()
+      if sweeps >= target or remaining <= 0:
+        return sweeps
+      sleep(min(poll_interval, remaining))
+      poll_interval = min(2*poll_interval, 2.)
 
   def readMeasurement(self, source:int):
     """
@@ -193,7 +295,8 @@ class dsoClass:
 
   def readMinSweep(self, first:int, last:int):
     """
-    Read the lowest number of sweeps acquired for all the measurements
+    Read the lowest number of sweeps acquired for all the configured measurements (non-empty equation).
+    A configured measurement without data counts as 0 sweeps.
 
     Parameters
     ----------
@@ -206,16 +309,65 @@ class dsoClass:
     -------
     int
       Lowest sweep number
+    
+    Raises
+    ------
+    ValueError
+      No measurement configured between first and last
     """
 
-    min_num = 9999999999999
+    meas = self.read_measurements(first, last, ('num', 'equation'))
+    used = np.char.strip(meas['equation']) != ''
+    if not used.any():
+      raise ValueError('No measurement configured in P'+str(first)+'..P'+str(last))
+    num = np.nan_to_num(meas['num'][used], nan=0.)
+    return int(num.min())
 
-    for i in range(first,last+1):
-      num = int(self.dso.query_vbs('app.Measure.P'+str(i)+'.num.Result.Value'))
-      if  num < min_num:
-        min_num = num
+  def read_measurements(self, first:int, last:int, fields=('value', 'mean', 'sdev', 'num')):
+    """
+    Read several fields of several measurements with a single VBS query
+    
+    Parameters
+    ----------
+    first : int
+      first measurement to retrieve (1 to 8)
+    last : int
+      last measurement to retrieve (1 to 8)
+    fields : iterable of str
+      Fields to read for each measurement (keys of `measureFields`)
 
-    return min_num
+    Returns
+    -------
+    numpy.recarray
+      One record per measurement: `param` (measurement number) and one float field per requested field,
+      NaN where the oscilloscope has no data (`equation` is text). Access the fields by key (`records['mean']`):
+      `mean`, `min` and `max` attributes are the array methods
+    
+    Raises
+    ------
+    DSOIOError
+      Unexpected number of values in the answer
+    """
+    fields = tuple(fields)
+    params = range(first, last+1)
+    query = '&";"&'.join('app.Measure.P'+str(i)+'.'+measureFields[f] for i in params for f in fields)
+    dsoAns = self.dso.query_vbs(query).split(';')
+    if len(dsoAns) != len(params)*len(fields):
+      raise DSOIOError('Expected '+str(len(params)*len(fields))+' measurement values, got '+str(len(dsoAns)))
+    
+    records = np.empty(len(params), dtype=[('param', 'i4')]+[(f, 'U64' if f in measureTextFields else 'f8') for f in fields])
+    records['param'] = params
+    for j, f in enumerate(fields):
+      answers = dsoAns[j::len(fields)]
+      if f in measureTextFields:
+        records[f] = answers
+        continue
+      for i, ans in enumerate(answers):
+        try:
+          records[f][i] = float(ans)
+        except ValueError:
+          records[f][i] = np.nan #No Data Available
+    return records.view(np.recarray)
 
   def saveWaveformToFile(self, dir:str, title:str, source:str):
     """
@@ -252,6 +404,53 @@ class dsoClass:
     print('File written: '+dsoAns)
     return dsoAns
   
+  def store_to_memory(self, source:str, memory:str):
+    """
+    Copy a waveform to an internal memory of the oscilloscope, and wait for the copy to complete
+    
+    Parameters
+    ----------
+    source : str
+      Source to copy: C1..C4 - F1..F8 - Z1..Z8
+    memory : str
+      Destination memory: M1..M4
+    """
+    self.dso.write('STORE '+source+','+memory)
+    self.dso.query('*OPC?')
+  
+  def get_waveform(self, source:str):
+    """
+    Download a waveform over the connection as a binary block (WF?) and scale it with the WAVEDESC descriptor,
+    without saving it to the oscilloscope disk and copying the file to the PC.
+    Single-segment waveforms only.
+    
+    Parameters
+    ----------
+    source : str
+      Source to download: C1..C4 - F1..F8 - Z1..Z8 - M1..M4 - ...
+      
+    Returns
+    -------
+    tuple of numpy.ndarray
+      Time (s) and voltage (V) of each point, float32
+    
+    Raises
+    ------
+    DSOIOError
+      Unexpected answer from the oscilloscope
+    """
+    visa = self.transport._visa
+    self.dso.write('COMM_FORMAT DEF9,WORD,BIN')
+    self.dso.write(source+':WF?')
+    #Answer: [prefix,]#9<9 digits: block length><block><LF>
+    while visa.read_bytes(1) != b'#':
+      pass
+    digits = int(visa.read_bytes(1))
+    length = int(visa.read_bytes(digits))
+    block = visa.read_bytes(length)
+    visa.read_bytes(1) #Response terminator
+    return parseWaveDesc(block)
+  
   def fileDsoToPc(self, remoteFile:str, localFile:str):
     """
     Transfer a file from the oscilloscope to the PC
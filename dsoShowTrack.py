@@ -10,7 +10,12 @@ plt.rc('font', size=12)
 plt.figure(0, figsize=(11, 7))
 filePath = sys.argv[1]
 print(filePath)
-trk = lecroyparser.ScopeData(filePath)
+if filePath.endswith('.npz'):
+  #Waveform downloaded with dsoClass.get_waveform
+  trk = np.load(filePath)
+  trk = type('Track', (), {'x': trk['t'], 'y': trk['v']})
+else:
+  trk = lecroyparser.ScopeData(filePath)
 trk.x = trk.x * 1000000
 plt.plot(trk.x, trk.y, label='IDE1140 Out')
 
@@ -1,5 +1,13 @@
 import pyvisa
-from utils import timestamp
+import numpy as np
+from utils import timestamp, BufferedLogWriter
+
+#Layout of the readout returned by PowerSupply.read_all
+readoutDtype = np.dtype([('ch', 'i4'), ('V', 'f8'), ('I', 'f8')])
+#Layout of the sample returned by PowerSupply.sample
+sampleDtype = np.dtype([('ts', 'f8'), ('ch', 'i4'), ('V', 'f8'), ('I', 'f8'), ('P', 'f8')])
+#Consecutive failures of the batched readout after which read_all uses only the single-channel queries
+batchedMaxFailures = 3
 
 class PowerSupply:
   """
@@ -16,11 +24,24 @@ class PowerSupply:
     '1': instrument connected with USB, '0': instrument connected with IP address
   resource: Resource
     handle to the instrument, when connection open; None otherwise
-  logger: file
-    handle of the file log
+  logger: BufferedLogWriter
+    handle of the file log, written in batches
+  batchedReadout: bool
+    chain the queries of all the channels in a single SCPI message in read_all; disabled when the instrument rejects
+    the command, or after batchedMaxFailures consecutive failures
+  batchedFailures: int
+    consecutive failures of the batched readout
+  nativePower: bool
+    read the power with MEAS:POW? in sample instead of computing it from voltage and current
+  selectedCh: int
+    channel currently selected in the instrument (INST OUT); None when unknown
+  selectWrites: int
+    number of channel selection commands sent to the instrument
+  selectWritesSaved: int
+    number of channel selection commands skipped because the channel was already selected
   """
   
-  def __init__(self, instr_string: str, usb: bool, ch: int= 4, timestr: str= ''):
+  def __init__(self, instr_string: str, usb: bool, ch: int= 4, timestr: str= '', logPrefix: str= 'psu_tc'):
     """
     Parameters
     ----------
@@ -32,12 +53,20 @@ class PowerSupply:
       number of channels of the power-supply unit; default: 4
     timestr: str, optional
       Timestamp to append to the log file; default: ''
+    logPrefix: str, optional
+      Name of the log file, before channels and timestamp; default: 'psu_tc'
     """
     self.channels = ch
     self.instr_string = instr_string
     self.usb = usb
     self.resource = None
-    self.logger = open('log/psu_tc_'+ str(ch) + 'ch_' + timestr + '.txt', 'w')
+    self.batchedReadout = True
+    self.batchedFailures = 0
+    self.nativePower = False
+    self.selectedCh = None
+    self.selectWrites = 0
+    self.selectWritesSaved = 0
+    self.logger = BufferedLogWriter('log/'+ logPrefix + '_'+ str(ch) + 'ch_' + timestr + '.txt')
     self.connect()
   
   def __del__(self):
@@ -54,6 +83,7 @@ class PowerSupply:
       Failed the connection to the instrument
     Re-raise other exceptions
     """
+    self.selectedCh = None
     try:
       rm = pyvisa.ResourceManager()
       if not self.usb:
@@ -79,6 +109,7 @@ class PowerSupply:
     if self.resource:
       self.resource.close()
       self.resource = None
+      self.selectedCh = None
       print("Disconnected from power supply")
     else:
       raise pyvisa.errors.VisaIOError('PSU not connected')
@@ -108,6 +139,72 @@ class PowerSupply:
     else:
       raise pyvisa.errors.VisaIOError('PSU not connected')
  
+  def customCommand(self, cmdStr: str):
+    """
+    Send a SCPI command to the instrument.
+    The command could change the selected channel, so the selection cache is invalidated.
+    
+    Parameters
+    ----------
+    cmdStr : str
+      SCPI string of the command
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      self.selectedCh = None
+      self._write(cmdStr)
+      self.log(cmdStr)
+    else:
+      raise pyvisa.errors.VisaIOError('PSU not connected')
+
+  def select_channel(self, ch: int):
+    """
+    Select a channel, skipping the command if the channel is already selected in the instrument
+    
+    Parameters
+    ----------
+    ch : int
+      Addressed channel
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      if self.selectedCh == ch:
+        self.selectWritesSaved += 1
+        return
+      self._write(f'INST OUT{ch}')
+      self.selectedCh = int(ch)
+      self.selectWrites += 1
+    else:
+      raise pyvisa.errors.VisaIOError('PSU not connected')
+
+  def _write(self, cmdStr: str):
+    """
+    Write a command, invalidating the selection cache if the instrument fails
+    """
+    try:
+      self.resource.write(cmdStr)
+    except:
+      self.selectedCh = None
+      raise
+
+  def _query(self, queryStr: str):
+    """
+    Query the instrument, invalidating the selection cache if the instrument fails
+    """
+    try:
+      return self.resource.query(queryStr)
+    except:
+      self.selectedCh = None
+      raise
+
   def set_voltage(self, ch:int, voltage:float):
     """
     Set voltage of a single channel
@@ -126,8 +223,8 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
-      self.resource.write(f"VOLT {voltage}")
+      self.select_channel(ch)
+      self._write(f"VOLT {voltage}")
       #self.log(f'INST:SEL {ch} VOLT {voltage}')
       self.log(f'INST OUT{ch} VOLT {voltage}')
       print(f"Set voltage to {voltage} V for channel {ch}")
@@ -152,8 +249,8 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
-      self.resource.write(f"CURR {current}")
+      self.select_channel(ch)
+      self._write(f"CURR {current}")
       #self.log(f'INST:SEL {ch} CURR {current}')
       self.log(f'INST OUT{ch} CURR {current}')
       print(f"Set current to {current} A")
@@ -176,8 +273,8 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
-      self.resource.write("OUTP ON")
+      self.select_channel(ch)
+      self._write("OUTP ON")
       #self.log(f'INST:SEL {ch} OUTP ON')
       self.log(f'INST OUT{ch} OUTP ON')
       print("Output turned ON")
@@ -200,8 +297,8 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
-      self.resource.write("OUTP OFF")
+      self.select_channel(ch)
+      self._write("OUTP OFF")
       #self.log(f'INST:SEL {ch} OUTP OFF')
       self.log(f'INST OUT{ch} OUTP OFF')
       print("Output turned OFF")
@@ -262,10 +359,10 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
+      self.select_channel(ch)
       #self.log(f'INST:SEL {ch} query(:meas:curr?)')
       self.log(f'INST OUT{ch} query(MEAS:CURR?)')
-      return float(self.resource.query("MEAS:CURR?"))
+      return float(self._query("MEAS:CURR?"))
     else:
       raise pyvisa.errors.VisaIOError('PSU not connected')
 
@@ -290,8 +387,8 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
-      voltage = self.resource.query("MEAS:VOLT?")
+      self.select_channel(ch)
+      voltage = self._query("MEAS:VOLT?")
       #self.log(f'INST:SEL {ch} query(MEAS:VOLT?)')
       self.log(f'INST OUT{ch} query(MEAS:VOLT?)')
       return float(voltage)
@@ -320,8 +417,8 @@ class PowerSupply:
     """
     if self.resource:
       #self.resource.write(f'INST:SEL {ch}')
-      self.resource.write(f'INST OUT{ch}')
-      current = self.resource.query("MEAS:POW?")
+      self.select_channel(ch)
+      current = self._query("MEAS:POW?")
       #self.log(f'INST:SEL {ch} query(MEAS:POW?)')
       self.log(f'INST OUT{ch} query(MEAS:POW?)')
       return float(current)
@@ -354,6 +451,145 @@ class PowerSupply:
     else:
       raise pyvisa.errors.VisaIOError('PSU not connected')
   
+  def read_all(self, channels=None):
+    """
+    Read voltage and current of several channels with as few round trips as possible.
+    The selection and the measurement queries of all the channels are chained in a single SCPI message;
+    if the instrument does not accept it, fall back to the single-channel queries.
+    
+    Parameters
+    ----------
+    channels : list of int, optional
+      Addressed channels; default: all the channels (1 to channels)
+    
+    Returns
+    -------
+    numpy.ndarray
+      Structured array (readoutDtype) with one row per channel and fields 'ch', 'V', 'I'
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    if self.resource:
+      if channels is None:
+        channels = range(1, self.channels+1)
+      readout = np.zeros(len(channels), dtype=readoutDtype)
+      readout['ch'] = channels
+      
+      if self.batchedReadout:
+        try:
+          self._read_all_batched(readout)
+          self.batchedFailures = 0
+          return readout
+        except (pyvisa.errors.VisaIOError, ValueError) as e:
+          self.selectedCh = None
+          if isinstance(e, pyvisa.errors.VisaIOError):
+            #Discard a late answer, that the next query would read instead of its own
+            try:
+              self.resource.clear()
+            except pyvisa.errors.VisaIOError:
+              pass
+          self.batchedFailures += 1
+          if self._command_error() or self.batchedFailures >= batchedMaxFailures:
+            print(f'Batched readout not supported ({e}): using single-channel queries')
+            self.batchedReadout = False
+          else:
+            print(f'Batched readout failed ({e}): using single-channel queries for this readout')
+      
+      for it,ch in enumerate(readout['ch']):
+        readout['V'][it] = self.get_voltage(ch)
+        readout['I'][it] = self.get_current(ch)
+      return readout
+    else:
+      raise pyvisa.errors.VisaIOError('PSU not connected')
+  
+  def _command_error(self):
+    """
+    Check if the last error of the instrument is a command error (SCPI -100 to -199, e.g. undefined header)
+    
+    Returns
+    -------
+    bool
+      True if the instrument rejected a command; False otherwise, or if the error queue cannot be read
+    """
+    try:
+      code = int(self._query('SYST:ERR?').split(',')[0])
+    except (pyvisa.errors.VisaIOError, ValueError):
+      return False
+    return -199 <= code <= -100
+  
+  def _read_all_batched(self, readout):
+    """
+    Fill the readout with a single semicolon-chained query for all the channels
+    
+    Parameters
+    ----------
+    readout : numpy.ndarray
+      Structured array (readoutDtype) with the channels to read; 'V' and 'I' are filled in place
+    
+    Raises
+    ------
+    ValueError
+      The answer does not contain one voltage and one current per channel
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or query rejected
+    """
+    cmdList = []
+    for ch in readout['ch']:
+      if ch == self.selectedCh and not cmdList:
+        self.selectWritesSaved += 1
+      else:
+        cmdList.append(f'INST OUT{ch}')
+        self.selectWrites += 1
+      cmdList += ['MEAS:VOLT?', 'MEAS:CURR?']
+    cmd = ';:'.join(cmdList)
+    self.log(f'query({cmd})')
+    answer = self._query(cmd).strip().split(';')
+    if len(answer) != 2*len(readout):
+      self.selectedCh = None
+      raise ValueError(f'expected {2*len(readout)} values, got {len(answer)}')
+    self.selectedCh = int(readout['ch'][-1])
+    values = np.asarray(answer, dtype=float)
+    readout['V'] = values[0::2]
+    readout['I'] = values[1::2]
+
+  def sample(self, channels=None):
+    """
+    Take a single voltage/current/power sample of several channels.
+    Voltage and current come from the same read_all call, and the power is computed from them
+    (or read with get_power if nativePower is set), so all the values refer to the same instant.
+    
+    Parameters
+    ----------
+    channels : list of int, optional
+      Addressed channels; default: all the channels (1 to channels)
+    
+    Returns
+    -------
+    numpy.ndarray
+      Structured array (sampleDtype) with one row per channel and fields 'ts', 'ch', 'V', 'I', 'P'
+    
+    Raises
+    ------
+    pyvisa.errors.VisaIOError
+      Instrument unavailable or not connected
+    """
+    ts = timestamp()
+    readout = self.read_all(channels)
+    smp = np.zeros(len(readout), dtype=sampleDtype)
+    smp['ts'] = ts
+    smp['ch'] = readout['ch']
+    smp['V'] = readout['V']
+    smp['I'] = readout['I']
+    if self.nativePower:
+      for it,ch in enumerate(smp['ch']):
+        smp['P'][it] = self.get_power(ch)
+    else:
+      smp['P'] = smp['V'] * smp['I']
+    return smp
+
   def log(self, txt: str):
     """
     Append a time-stamped line to the log
@@ -365,7 +601,6 @@ class PowerSupply:
     """
     ts = timestamp()
     self.logger.write(str(ts)+','+txt+'\n')
-    self.logger.flush()
 
   def csvHeader(self):
     """
@@ -6,6 +6,7 @@ import os
 
 from psu import *
 from utils import *
+from tvacStorage import openLog, formats
 
 from pyqtgraph import GraphicsLayoutWidget
 from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
@@ -20,9 +21,9 @@ import matplotlib.pyplot as plt
 
 
 class PlotCurrentWidget(QtWidgets.QMainWindow):
-    def __init__(self, title, xlabel, ylabel, channel, psu):
+    def __init__(self, title, xlabel, ylabel, channel, psu, psu_channels=4, window=7200, period=20):
         #self.init_multiple_plots(title, xlabel, ylabel, channel, psu)
-        self.init_single_plot(psu)
+        self.init_single_plot(psu, psu_channels, window, period)
 
     def init_multiple_plots(self, title, xlabel, ylabel, channel, psu):
         self.title = title
@@ -60,7 +61,8 @@ class PlotCurrentWidget(QtWidgets.QMainWindow):
         )
     
     #Plot all the currents in a single plot; plot all the voltages in a single plot
-    def init_single_plot(self, psu, psu_channels=4):
+    #window and period (in seconds) size the history buffers
+    def init_single_plot(self, psu, psu_channels=4, window=7200, period=20):
         self.psu = psu
         super().__init__()
 
@@ -98,10 +100,10 @@ class PlotCurrentWidget(QtWidgets.QMainWindow):
         self.power_plot_graph.addLegend(offset=(1,1))
         self.power_plot_graph.showGrid(x=True, y=True)
 
-        self.time = []
-        self.current = [[], [], [], []]
-        self.volts = [[], [], [], []]
-        self.powers = [[], [], [], []]
+        # History buffers
+        self.current = RingBuffer(psu_channels, window, period)
+        self.volts = RingBuffer(psu_channels, window, period)
+        self.powers = RingBuffer(psu_channels, window, period)
         
         # Plot line reference for currents
         colormap = plt.colormaps['tab20']
@@ -112,8 +114,8 @@ class PlotCurrentWidget(QtWidgets.QMainWindow):
 
         for it in range(0, psu_channels):
             curr_line = self.curr_plot_graph.plot(
-                self.time,
-                self.current[it],
+                self.current.times(),
+                self.current.channel(it),
                 name=f"Current ch.{it}",
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
                 #symbol=symbols[it],
@@ -122,8 +124,8 @@ class PlotCurrentWidget(QtWidgets.QMainWindow):
             self.curr_plots.append(curr_line)
 
             volt_line = self.volt_plot_graph.plot(
-                self.time,
-                self.volts[it],
+                self.volts.times(),
+                self.volts.channel(it),
                 name=f"Voltage ch.{it}",
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
                 #symbol=symbols[it],
@@ -132,14 +134,19 @@ class PlotCurrentWidget(QtWidgets.QMainWindow):
             self.volt_plots.append(volt_line)
 
             power_line = self.power_plot_graph.plot(
-                self.time,
-                self.powers[it],
+                self.powers.times(),
+                self.powers.channel(it),
                 name=f"Power ch.{it}",
                 pen = (colormap(it)[0] * 255, colormap(it)[1] * 255, colormap(it)[2] * 255),
                 #symbol = 'x',
                 #symbolBrush=colormap(it),
             )
             self.power_plots.append(power_line)
+
+        # Level-of-detail layers: decimated curves for the visible range
+        self.lod_currs = LodPlot(self.curr_plot_graph, self.curr_plots, self.current)
+        self.lod_volts = LodPlot(self.volt_plot_graph, self.volt_plots, self.volts)
+        self.lod_pwrs = LodPlot(self.power_plot_graph, self.power_plots, self.powers)
     
     def update_plot(self, psu, channel, ts):
         if len(self.time)<120:
@@ -154,57 +161,36 @@ class PlotCurrentWidget(QtWidgets.QMainWindow):
         self.line.setData(self.time, self.current)
     
     def update_plots(self, psu, ts):
-        #Discard data older than 2 hours and append time
-        if len(self.time) > 120:
-            self.time = self.time[1:]
-        self.time.append(ts)
-        #Read and append currents
-        for channel in range(0, psu.channels):
-            if len(self.time) > 120:
-                self.current[channel] = self.current[channel][1:]
-            self.current[channel].append(psu.get_current(int(channel+1)))
-            self.curr_plots[channel].setData(self.time, self.current[channel])
+        #Read and plot currents and voltages of all the channels
+        readout = psu.read_all()
+        self.update_currs_volts(ts, readout['I'], readout['V'])
     
     def update_currs_volts(self, ts, currs, volts):
-        #Discard data older than 2 hours and append time
-        if len(self.time) > 360:
-            self.time = self.time[1:]
-            for channel in range(0, len(currs)):
-                self.current[channel] = self.current[channel][1:]
-                self.volts[channel] = self.volts[channel][1:]
-                self.powers[channel] =  self.powers[channel][1:]
-        self.time.append(ts)
+        #Append the sample: the buffers discard the data older than the plot window
+        self.current.append(ts, currs)
+        self.volts.append(ts, volts)
+        self.powers.append(ts, np.multiply(currs, volts))
         #Plot currents and voltages
-        for channel in range(0, len(currs)):
-            self.current[channel].append(currs[channel])
-            self.volts[channel].append(volts[channel])
-            self.powers[channel].append(currs[channel]*volts[channel])
-            self.curr_plots[channel].setData(self.time, self.current[channel])
-            self.volt_plots[channel].setData(self.time, self.volts[channel])
-            self.power_plots[channel].setData(self.time, self.powers[channel])
+        self.lod_currs.refresh()
+        self.lod_volts.refresh()
+        self.lod_pwrs.refresh()
 
 def update_measure(psu, widgets, logfile, psu_channels):
     ts = timestamp()
     #Acquire values
-    voltages = []
-    currents = []
-    for it in range(psu_channels):
-        voltages.append(psu.get_voltage(it+1))
-        currents.append(psu.get_current(it+1))
-
-    #Write to file
-    logfile.write(str(ts))
-    for it in range(psu_channels):
-        logfile.write(','+str(voltages[it])+','+str(currents[it]))
-    logfile.write('\n')
-    logfile.flush()
+    readout = psu.read_all(range(1, psu_channels+1))
+    voltages = readout['V']
+    currents = readout['I']
+
+    #Write to file: V, I of each channel
+    logfile.row(ts, np.column_stack((voltages, currents)).ravel())
     
     #Update plots
     widgets.update_currs_volts(ts, currents, voltages)
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, logfile, psu_channels, timestr):
+    def __init__(self, logfile, psu_channels, timestr, plot_window=7200):
         super().__init__()
         self.setWindowTitle("Rohde&Schwarz PSU ("+str(psu_channels)+' channels)')
         self.resize(1440, 900)
@@ -254,14 +240,15 @@ class MainWindow(QtWidgets.QMainWindow):
                 start_btn.setEnabled(True)
 
                 # Write IDN to log file
-                logfile.write('#IDN: ' + self.alim.idn() + '\n')
+                logfile.comment('IDN: ' + self.alim.idn())
             except pyvisa.errors.VisaIOError:
                 print("Error connecting to the power supply")
                 self.alim = None
         
         #Plots widget
+        period = 20 # Logging period, in seconds
         widgets = []
-        plot_widget = PlotCurrentWidget(f"Current", "Time", "Current (A)", 0, self.alim)
+        plot_widget = PlotCurrentWidget(f"Current", "Time", "Current (A)", 0, self.alim, psu_channels, plot_window, period)
         #Add current, voltage, power plot
         widgets.append(plot_widget.curr_plot_graph)
         plotLayout.addWidget(widgets[0])
@@ -271,10 +258,10 @@ class MainWindow(QtWidgets.QMainWindow):
         plotLayout.addWidget(widgets[2])
 
         # Write column names to logfile
-        logfile.write('#Time Stamp')
+        columns = []
         for it in range(psu_channels):
-            logfile.write(', Ch.'+str(it+1)+' Voltage (V), Ch.'+str(it+1)+' Current (A)')
-        logfile.write('\n')
+            columns += [' Ch.'+str(it+1)+' Voltage (V)', ' Ch.'+str(it+1)+' Current (A)']
+        logfile.header(columns, '#Time Stamp')
 
 
         #Buttons actions
@@ -293,7 +280,7 @@ class MainWindow(QtWidgets.QMainWindow):
             ctrlsLayout.addLayout(self.add_ch_button(btn , str(btn)), btn-1, 1)
 
         timer = QtCore.QTimer()
-        timer.setInterval(20000)
+        timer.setInterval(period*1000)
         timer.timeout.connect(lambda: update_measure(self.alim, plot_widget, logfile, psu_channels))
 
     def __del__(self):
@@ -318,26 +305,28 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
 def main():
-    if(len(sys.argv) != 2):
+    if(len(sys.argv) not in (2, 3) or sys.argv[2:] and sys.argv[2] not in formats):
         print('Usage:')
-        print('\tPSU_plotter <number of channels>')
+        print('\tPSU_plotter <number of channels> [log format: ' + '|'.join(formats) + ', default: csv]')
         sys.exit()
     timestr = time.strftime("%Y%m%d_%H%M%S")
     psu_channels = int(sys.argv[1])
+    log_format = sys.argv[2] if len(sys.argv) == 3 else 'csv'
     print(psu_channels)
+    plot_window = 31*24*3600 # Time span of the live plots, in seconds: full resolution, decimated on display
     
     # Check if log folder exists
     if not os.path.exists('log'):
         os.makedirs('log')
 
-    with open('log/psu_'+ str(psu_channels) + 'ch_' + timestr + '.txt', 'w') as logfile:
+    with openLog('log/psu_'+ str(psu_channels) + 'ch_' + timestr, log_format) as logfile:
 
         # Write header
-        logfile.write('#Rohde&Schwarz PSU log file\n')
-        logfile.write('#Date: ' + timestr + '\n')
+        logfile.comment('Rohde&Schwarz PSU log file')
+        logfile.comment('Date: ' + timestr)
         
         app = QtWidgets.QApplication(sys.argv)
-        main_window = MainWindow(logfile, psu_channels, timestr)
+        main_window = MainWindow(logfile, psu_channels, timestr, plot_window)
         main_window.show()
         sys.exit(app.exec())
 
@@ -0,0 +1,250 @@
+import os
+import queue
+import threading
+from collections import defaultdict
+from time import perf_counter
+import numpy as np
+
+class _TimedLock:
+  """
+  Lock of the engine that records the time spent waiting for it as a stage
+  """
+  
+  def __init__(self, engine, stage:str):
+    self.engine = engine
+    self.stage = stage
+  
+  def __enter__(self):
+    t = perf_counter()
+    self.engine.lock.acquire()
+    self.engine._stage(self.stage, t)
+  
+  def __exit__(self, *args):
+    self.engine.lock.release()
+
+class PulseScanEngine:
+  """
+  Test-pulse scan that overlaps the download of a step with the acquisition of the next ones.
+  
+  At each step the main thread waits for the sweeps, copies the waveform to a free internal memory (M1..M4),
+  sets the pulser to the next level and arms the oscilloscope again; only then the step is queued to a worker thread,
+  that downloads the memory over the connection, frees it and writes the waveform to a `.npz` file,
+  while the oscilloscope acquires the next step. The free memories are a bounded queue: when all of them wait
+  for the download, the scan waits (backpressure). The oscilloscope connection is shared through a lock,
+  held for one transaction at a time; the time spent waiting for it is reported apart and not counted as busy time.
+  """
+  
+  def __init__(self, dso, pulser, source:str, localPath:str, traceName:str, pulseLow:float,
+               sweeps:int, timeout:float = 60, sweepSrc:str = None, memories = ('M1', 'M2', 'M3', 'M4'), params = (1, 8)):
+    """
+    Parameters
+    ----------
+    dso : dso.dsoClass
+      Oscilloscope
+    pulser : pulser.pulserClass
+      Pulser, with shape, frequency, width and low level already set
+    source : str
+      DSO source to store: C1..C4 - F1..F8 - Z1..Z8
+    localPath : str
+      Directory where to write the waveforms
+    traceName : str
+      Trace name: added to the file names
+    pulseLow : float
+      Low level of the pulser (V), stored with the waveforms
+    sweeps : int
+      Sweeps to acquire at each step
+    timeout : float
+      Maximum acquisition time for each step (s): the step is not saved if the sweeps are not reached
+    sweepSrc : str
+      DSO channel whose averaged sweeps are counted. If None, the lowest sweep count of the measurements
+    memories : iterable of str
+      Oscilloscope memories used as buffers between acquisition and download
+    params : tuple of int
+      First and last measurement whose sweeps are counted, if sweepSrc is None
+    """
+    self.dso = dso
+    self.pulser = pulser
+    self.source = source
+    self.localPath = localPath
+    self.traceName = traceName
+    self.pulseLow = pulseLow
+    self.sweeps = sweeps
+    self.timeout = timeout
+    self.sweepSrc = sweepSrc
+    self.params = params
+    
+    self.lock = threading.Lock()
+    self.mainLock = _TimedLock(self, 'lock wait')
+    self.workerLock = _TimedLock(self, 'worker lock wait')
+    self.freeMemories = queue.Queue()
+    for memory in memories:
+      self.freeMemories.put(memory)
+    self.jobs = queue.Queue(maxsize=len(memories))
+    
+    self.timings = defaultdict(list)
+    self.mainBusy = 0.
+    self.workerBusy = 0.
+    self.wall = 0.
+    self.saved = []
+    self.skipped = []
+    self.errors = []
+  
+  def _stage(self, stage:str, t0:float):
+    """
+    Record the duration of a stage started at t0, and return the current time
+    """
+    t1 = perf_counter()
+    self.timings[stage].append(t1-t0)
+    return t1
+  
+  def run(self, levels):
+    """
+    Perform the scan
+    
+    Parameters
+    ----------
+    levels : iterable of float
+      High levels of the pulser (V)
+    
+    Returns
+    -------
+    list of str
+      Files written
+    """
+    os.makedirs(self.localPath, exist_ok=True)
+    worker = threading.Thread(target=self._worker, name='pulseScanWorker', daemon=True)
+    start = perf_counter()
+    worker.start()
+    levels = list(levels)
+    armed = False
+    try:
+      for step, level in enumerate(levels):
+        if not armed:
+          self._arm(level)
+        armed = False
+        
+        t = perf_counter()
+        sweeps = self.dso.wait_for_sweeps(self.sweeps, self.timeout, channel=self.sweepSrc,
+                                          first=self.params[0], last=self.params[1], lock=self.mainLock)
+        with self.mainLock:
+          self.dso.setTriggerMode('Stopped')
+        t = self._stage('acquire', t)
+        if sweeps < self.sweeps:
+          print('WARNING: only '+str(sweeps)+' of '+str(self.sweeps)+' sweeps acquired in '+f'{self.timeout:g}'+' s: waveform not saved')
+          self.skipped.append(step)
+          continue
+        
+        #Blocks while all the memories wait for the download
+        memory = self._waitWorker(worker, self.freeMemories.get)
+        t = self._stage('backpressure', t)
+        
+        with self.mainLock:
+          self.dso.store_to_memory(self.source, memory)
+        self._stage('snapshot', t)
+        
+        #Next step acquiring before the download starts: the two overlap
+        if step+1 < len(levels):
+          self._arm(levels[step+1])
+          armed = True
+        self._waitWorker(worker, self.jobs.put, (step, level, memory))
+    finally:
+      if worker.is_alive():
+        self._waitWorker(worker, self.jobs.put, None)
+        worker.join()
+      self.wall = perf_counter() - start
+      self.mainBusy = (sum(sum(self.timings[s]) for s in ('pulser', 'arm', 'acquire', 'snapshot'))
+                       - sum(self.timings['lock wait']))
+      self.workerBusy = (sum(sum(self.timings[s]) for s in ('download', 'write'))
+                         - sum(self.timings['worker lock wait']))
+    return self.saved
+  
+  def _arm(self, level:float):
+    """
+    Set the pulser level and start the acquisition of a step
+    
+    Parameters
+    ----------
+    level : float
+      High level of the pulser (V)
+    """
+    print('High End: '+f'{level:1.3f}'+' V - Pulse height: '+f'{(level-self.pulseLow):1.3f}'+' V')
+    t = perf_counter()
+    self.pulser.setVoltageHigh(level)
+    t = self._stage('pulser', t)
+    
+    with self.mainLock:
+      self.dso.setTriggerMode('Normal')
+      self.dso.clear_sweeps()
+    self._stage('arm', t)
+  
+  @staticmethod
+  def _waitWorker(worker, function, *args):
+    """
+    Call a blocking queue function (get or put) as long as the worker thread is alive
+    
+    Raises
+    ------
+    RuntimeError
+      The worker thread stopped
+    """
+    while worker.is_alive():
+      try:
+        return function(*args, timeout=1.)
+      except (queue.Empty, queue.Full):
+        pass
+    raise RuntimeError('The download worker of the scan stopped')
+  
+  def _worker(self):
+    """
+    Download the memories queued by run and write them to file
+    """
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+      step, level, memory = job
+      t = perf_counter()
+      try:
+        with self.workerLock:
+          times, volts = self.dso.get_waveform(memory)
+      except Exception as e:
+        print('ERROR: download of step '+str(step)+' from '+memory+' failed: '+str(e))
+        self.errors.append(step)
+        continue
+      finally:
+        self.freeMemories.put(memory)
+        t = self._stage('download', t)
+      
+      fileName = os.path.join(self.localPath, f'{self.traceName}_{step:03d}.npz')
+      try:
+        np.savez(fileName, t=times, v=volts, high=level, low=self.pulseLow)
+      except Exception as e:
+        print('ERROR: writing step '+str(step)+' to '+fileName+' failed: '+str(e))
+        self.errors.append(step)
+        continue
+      finally:
+        self._stage('write', t)
+      self.saved.append(fileName)
+  
+  def report(self):
+    """
+    Summary of the stage timings of the last run
+    
+    Returns
+    -------
+    str
+      Total and mean time of each stage (the lock waits are included in the stages and listed apart),
+      busy time of the two threads without the lock waits and the time hidden by the overlap
+    """
+    lines = [f'{"Stage":<18}{"Count":>6}{"Total (s)":>11}{"Mean (s)":>10}']
+    for stage in ('pulser', 'arm', 'acquire', 'backpressure', 'snapshot', 'lock wait', 'download', 'write', 'worker lock wait'):
+      durations = self.timings.get(stage, [])
+      if durations:
+        lines.append(f'{stage:<18}{len(durations):>6}{sum(durations):>11.3f}{np.mean(durations):>10.3f}')
+    sequential = self.mainBusy + self.workerBusy
+    hidden = min(max(sequential - self.wall, 0.), self.workerBusy)
+    lines.append(f'Saved: {len(self.saved)} - Skipped: {len(self.skipped)} - Failed: {len(self.errors)}')
+    lines.append(f'Scan busy: {self.mainBusy:.3f} s - Worker busy: {self.workerBusy:.3f} s')
+    lines.append(f'Wall time: {self.wall:.3f} s - Sequential estimate: {sequential:.3f} s - Hidden by overlap: {hidden:.3f} s'
+                 + (f' ({100*hidden/self.workerBusy:.0f}% of the worker time)' if self.workerBusy > 0 else ''))
+    return '\n'.join(lines)
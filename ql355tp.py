@@ -20,8 +20,8 @@ class ql355tpPsu(PowerSupply):
     timestr: str, optional
       Timestamp to append to the log file; default: ''
     """
-    super().__init__(instr_string, usb, ch, timestr)
-    self.logger = open('log/ql355_tc_'+ str(ch) + 'ch_' + timestr + '.txt', 'w')
+    super().__init__(instr_string, usb, ch, timestr, 'ql355_tc')
+    self.batchedReadout = False #Serial protocol: no SCPI chaining
   
   def get_voltage(self, ch:int):
     """
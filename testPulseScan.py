@@ -1,7 +1,8 @@
-from dso import dsoClass
+from dso import dsoClass, measureFields, measureTextFields
 from pulser import pulserClass
-from time import sleep
+from pulseScanEngine import PulseScanEngine
 import argparse
+import os
 import numpy as np
 
 parser = argparse.ArgumentParser(description='Use Tektronix pulser and HD6104 oscilloscope to perform a test-pulse scan')
@@ -13,13 +14,59 @@ parser.add_argument('--path', dest='filePath', action='store',
 parser.add_argument('--src', action='store',
                     default='Z1',
                     help='DSO source to store. Default: Z1')
+parser.add_argument('--local', dest='localPath', action='store',
+                    default=None,
+                    help='Download the waveforms over the connection and store them (.npz) in this directory of the PC, instead of the oscilloscope disk')
+parser.add_argument('--sweeps', action='store', type=int,
+                    default=500,
+                    help='Sweeps to acquire at each step before saving. Default: 500')
+parser.add_argument('--sweep-src', dest='sweepSrc', action='store',
+                    default=None,
+                    help='DSO channel whose averaged sweeps are counted (C1..C4). Default: lowest sweep count of the measurements --params')
+parser.add_argument('--timeout', action='store', type=float,
+                    default=60,
+                    help='Maximum acquisition time for each step (s): the step is not saved if the sweeps are not reached. Default: 60')
+parser.add_argument('--pipeline', action='store_true',
+                    help='Download and store each step (requires --local) while the next steps are acquired, and report the stage timings')
+parser.add_argument('--measure-only', dest='measureOnly', action='store_true',
+                    help='Do not store the waveforms: store a table of the DSO measurements of each step (.csv and .npy, in --local or the current directory)')
+parser.add_argument('--params', action='store', type=int, nargs=2,
+                    default=[1, 8], metavar=('FIRST', 'LAST'),
+                    help='Measurements whose sweeps are counted (without --sweep-src) and stored with --measure-only. Default: 1 8 (P1..P8)')
+parser.add_argument('--fields', action='store',
+                    default='mean,sdev,num',
+                    help='Comma-separated measurement fields to store with --measure-only ('+', '.join(f for f in measureFields if f not in measureTextFields)+'). Default: mean,sdev,num')
 args = parser.parse_args()
+if args.pipeline and args.localPath is None:
+  parser.error('--pipeline requires --local')
+if args.pipeline and args.measureOnly:
+  parser.error('--pipeline and --measure-only are mutually exclusive')
+fields = args.fields.split(',')
+if any(f not in measureFields or f in measureTextFields for f in fields):
+  parser.error('unknown measurement field in --fields: '+args.fields)
 
-print('Storing waveforms in:\t'+args.filePath)
+if args.measureOnly:
+  tablePath = os.path.join(args.localPath or '.', args.traceName+'_measurements')
+  os.makedirs(args.localPath or '.', exist_ok=True)
+  print('Storing measurements in:\t'+tablePath+'.csv/.npy (PC)')
+elif args.localPath is not None:
+  os.makedirs(args.localPath, exist_ok=True)
+  print('Storing waveforms in:\t'+args.localPath+' (PC)')
+else:
+  print('Storing waveforms in:\t'+args.filePath)
 print('Waveform to store:\t'+args.src)
 print('Trace name:\t\t'+args.traceName)
 
 dso = dsoClass()
+
+#Sweeps counted on the measurements: at least one must be configured
+if args.sweepSrc is None:
+  try:
+    dso.readMinSweep(args.params[0], args.params[1])
+  except ValueError as e:
+    print('ERROR: '+str(e)+': configure a measurement in the oscilloscope, or count the sweeps of a channel with --sweep-src')
+    exit(-1)
+
 pulser = pulserClass()
 
 #Pulser setup: 100 Hz, 1 ms wide, starting from -2V
@@ -46,21 +93,60 @@ pulser.setVoltageLow(pulseLowEnd)
 pulser.setVoltageHigh(pulseHighEnd[0])
 pulser.outEn('ON')
 
-for it in pulseHighEnd:
-  #Set and apply voltage
-  pulser.setVoltageHigh(it)
-  print('High End: '+f'{it:1.3f}'+' V - Pulse height: '+f'{(it-pulseLowEnd):1.3f}'+' V')
-  
-  #DSO acquisition
-  dso.setTriggerMode('Normal')
+tableFile = None
+try:
+  if args.measureOnly:
+    #One row per step: pulser levels, sweeps and the fields of each measurement
+    params = range(args.params[0], args.params[1]+1)
+    tableDtype = [('step', 'i4'), ('high', 'f8'), ('low', 'f8'), ('sweeps', 'i8')]+[('P'+str(i)+'_'+f, 'f8') for i in params for f in fields]
+    table = []
+    tableFile = open(tablePath+'.csv', 'w')
+    for i in params:
+      try:
+        tableFile.write('#P'+str(i)+': '+dso.readMeasurementName(i)+'\n')
+      except ValueError:
+        tableFile.write('#P'+str(i)+': \n')
+    tableFile.write(','.join(name for name, _ in tableDtype)+'\n')
   
-  #Wait the DSO to be ready
-  sleep(10)
-  
-  #Stop DSO and save waveform
-  dso.setTriggerMode('Stopped')
-  dso.saveWaveformToFile(args.filePath, args.traceName, args.src)
-
+  if args.pipeline:
+    engine = PulseScanEngine(dso, pulser, args.src, args.localPath, args.traceName, pulseLowEnd,
+                             args.sweeps, args.timeout, args.sweepSrc, params=args.params)
+    engine.run(pulseHighEnd)
+    print(engine.report())
+  else:
+    for step, it in enumerate(pulseHighEnd):
+      #Set and apply voltage
+      pulser.setVoltageHigh(it)
+      print('High End: '+f'{it:1.3f}'+' V - Pulse height: '+f'{(it-pulseLowEnd):1.3f}'+' V')
+      
+      #DSO acquisition
+      dso.setTriggerMode('Normal')
+      dso.clear_sweeps()
+      
+      #Wait the DSO to be ready
+      sweeps = dso.wait_for_sweeps(args.sweeps, args.timeout, channel=args.sweepSrc, first=args.params[0], last=args.params[1])
+      
+      #Stop DSO and save waveform
+      dso.setTriggerMode('Stopped')
+      if sweeps < args.sweeps:
+        print('WARNING: only '+str(sweeps)+' of '+str(args.sweeps)+' sweeps acquired in '+f'{args.timeout:g}'+' s: '+('step' if args.measureOnly else 'waveform')+' not saved')
+        continue
+      if args.measureOnly:
+        meas = dso.read_measurements(args.params[0], args.params[1], fields)
+        row = (step, it, pulseLowEnd, sweeps)+tuple(meas[f][j] for j in range(len(meas)) for f in fields)
+        table.append(row)
+        tableFile.write(','.join(str(x) for x in row)+'\n')
+        tableFile.flush()
+      elif args.localPath is not None:
+        t, v = dso.get_waveform(args.src)
+        np.savez(os.path.join(args.localPath, f'{args.traceName}_{step:03d}.npz'), t=t, v=v, high=it, low=pulseLowEnd)
+      else:
+        dso.saveWaveformToFile(args.filePath, args.traceName, args.src)
+finally:
+  if tableFile is not None:
+    #Also on errors and Ctrl-C: the steps acquired so far
+    tableFile.close()
+    np.save(tablePath+'.npy', np.array(table, dtype=tableDtype))
 
 #Turn off everything
 pulser.outEn('OFF')
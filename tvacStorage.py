@@ -0,0 +1,554 @@
+"""
+Storage backends of the TVAC logs: the CSV text file, and an append-only binary file.
+
+The binary log is made of two files with the same base name:
+    <base>.json: schema (column names, dtype of the values, comments)
+    <base>.bin: fixed-size records, one per sample: Timestamp (float64) and one float32 per column
+The records are read back as a NumPy structured array (memory-mapped: columns are loaded on access).
+
+The CSV logs have a sidecar time index, <log>.idx: int64 pairs (timestamp, byte offset of the row), one every
+indexEvery seconds of log, to seek a time window without parsing the rows before it.
+It is written with the log, or built on the first read of a log without it (see loadIndex).
+
+LogCache keeps the parsed CSV logs as binary logs (float64 values), extended with the new rows when the log grows.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from utils import BufferedLogWriter
+
+formats = ('csv', 'bin')
+indexEvery = 600 # Time between two entries of the index of the CSV logs, in seconds
+indexDtype = np.dtype([('ts', '<i8'), ('offset', '<i8')])
+cacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'tvac') # Default directory of the LogCache
+
+class CsvLog:
+    """
+    Text log: comments start with '#', then a header line and one comma-separated row per sample.
+    The time index of the log is written along with the rows. The file is UTF-8 with '\\n' line endings on all
+    the platforms, so that the offsets counted while writing are the positions in the file.
+    """
+    def __init__(self, path, every=indexEvery, **kwargs):
+        """
+        Parameters
+        ----------
+        path: str
+            Log file
+        every: float
+            Time between two entries of the index, in seconds
+        kwargs:
+            Options of the BufferedLogWriter
+        """
+        self.path = path
+        self.every = every
+        kwargs.setdefault('encoding', 'utf-8')
+        kwargs.setdefault('newline', '')
+        self.file = BufferedLogWriter(path, **kwargs)
+        self.offset = os.path.getsize(path)
+        self.nextIndex = None
+        self.index = open(indexPath(path), 'ab' if 'a' in kwargs.get('mode', 'w') else 'wb')
+
+    def _write(self, text):
+        self.file.write(text)
+        self.offset += len(text.encode('utf-8'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def comment(self, text):
+        """
+        Append a comment line
+        """
+        self._write('#' + text + '\n')
+
+    def header(self, columns, timeName='Timestamp'):
+        """
+        Append the header line: the timestamp, then the columns of the rows
+        """
+        self._write(timeName + ''.join(',' + str(col) for col in columns) + '\n')
+
+    def row(self, ts, values):
+        """
+        Append one sample: timestamp and values, in the order of the header
+        """
+        if self.nextIndex is None or ts >= self.nextIndex:
+            # The entry may reach the disk before the row: the readers skip the entries beyond the end of the log
+            self.index.write(np.array([(int(ts), self.offset)], dtype=indexDtype).tobytes())
+            self.index.flush()
+            self.nextIndex = ts + self.every
+        self._write(str(ts) + ''.join(',' + str(val) for val in values) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+class BinaryLog:
+    """
+    Binary log: JSON schema and fixed-size records (see the module description)
+    """
+    def __init__(self, base, dtype='<f4', **kwargs):
+        """
+        Parameters
+        ----------
+        base: str
+            Path of the log files, without extension
+        dtype: str
+            Data type of the values
+        kwargs:
+            Options of the BufferedLogWriter of the records
+        """
+        self.path = base + '.bin'
+        self.schemaPath = base + '.json'
+        self.schema = dict(format='tvac-bin', version=1, time='<f8', dtype=np.dtype(dtype).str, columns=None, comments=[])
+        self.recordDtype = None
+        self.file = BufferedLogWriter(self.path, mode='wb', **kwargs)
+        self._writeSchema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _writeSchema(self):
+        tmp = self.schemaPath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.schema, f, indent=1)
+        os.replace(tmp, self.schemaPath)
+
+    def comment(self, text):
+        """
+        Add a comment to the schema
+        """
+        self.schema['comments'].append(text)
+        self._writeSchema()
+
+    def header(self, columns, timeName='Timestamp'):
+        """
+        Fix the columns of the records; a later header must repeat the same columns
+
+        Raises
+        ------
+        ValueError
+            Columns different from the ones of the records already written
+        """
+        columns = [str(col).strip() for col in columns]
+        if self.schema['columns'] is not None:
+            if columns != self.schema['columns']:
+                raise ValueError(f'{self.path}: columns differ from the ones of the records already written')
+            return
+        self.schema['columns'] = columns
+        self.recordDtype = recordDtype(self.schema)
+        self._writeSchema()
+
+    def row(self, ts, values):
+        """
+        Append one sample: timestamp and values, in the order of the header
+        """
+        record = np.empty(1, dtype=self.recordDtype)
+        record[0] = (ts, *values)
+        self.file.write(record.tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def openLog(base, fmt='csv', **kwargs):
+    """
+    Open a log with the selected storage backend
+
+    Parameters
+    ----------
+    base: str
+        Path of the log, without extension: '.txt' is added for the CSV, '.json' and '.bin' for the binary log
+    fmt: str
+        'csv' or 'bin'
+    kwargs:
+        Options of the BufferedLogWriter
+
+    Returns
+    -------
+    CsvLog or BinaryLog
+        Log, with the comment/header/row/flush/close interface
+    """
+    if fmt == 'csv':
+        return CsvLog(base + '.txt', **kwargs)
+    elif fmt == 'bin':
+        return BinaryLog(base, **kwargs)
+    raise ValueError(f'Unknown log format {fmt}: choose among {formats}')
+
+def recordDtype(schema):
+    """
+    Layout of the records described by a schema
+    """
+    return np.dtype([('Timestamp', schema['time'])] + [(col, schema['dtype']) for col in schema['columns']])
+
+def isBinary(path):
+    """
+    True if path is one of the files of a binary log
+    """
+    return os.path.splitext(path)[1] in ('.json', '.bin')
+
+def readBinary(path, mmap=True):
+    """
+    Read a binary log. A record still partially written at the end of the file is ignored.
+
+    Parameters
+    ----------
+    path: str
+        One of the files of the log ('.json' or '.bin'), or their base name
+    mmap: bool
+        Map the records in memory instead of loading them
+
+    Returns
+    -------
+    tuple
+        Schema (dict) and records (numpy structured array: Timestamp and the columns)
+    """
+    base = os.path.splitext(path)[0] if isBinary(path) else path
+    with open(base + '.json') as f:
+        schema = json.load(f)
+    dtype = recordDtype(schema)
+    records = os.path.getsize(base + '.bin') // dtype.itemsize
+    if records == 0:
+        return schema, np.empty(0, dtype=dtype)
+    if mmap:
+        return schema, np.memmap(base + '.bin', dtype=dtype, mode='r', shape=(records,))
+    return schema, np.fromfile(base + '.bin', dtype=dtype, count=records)
+
+def indexPath(path):
+    """
+    Time index of a CSV log
+    """
+    return path + '.idx'
+
+def buildIndex(path, every=indexEvery, index=None):
+    """
+    Scan a CSV log for its time index. Only the first field of the rows is parsed;
+    a last line still being written is not indexed.
+
+    Parameters
+    ----------
+    path: str
+        CSV log
+    every: float
+        Time between two entries of the index, in seconds
+    index: numpy.ndarray
+        Valid index of the first part of the log, to be extended (indexDtype); default: scan from the start
+
+    Returns
+    -------
+    numpy.ndarray
+        Index (indexDtype)
+    """
+    entries = [] if index is None else index.tolist()
+    offset = entries[-1][1] if entries else 0
+    nextIndex = entries[-1][0] + every if entries else None
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            if line[:1].isdigit():
+                ts = float(line[:line.find(b',')])
+                if nextIndex is None or ts >= nextIndex:
+                    if not entries or offset > entries[-1][1]:
+                        entries.append((int(ts), offset))
+                    nextIndex = ts + every
+            offset += len(line)
+    return np.array(entries, dtype=indexDtype)
+
+def loadIndex(path, every=indexEvery):
+    """
+    Time index of a CSV log, valid also while the log is appended: the entries beyond the end of the log are dropped,
+    and the rows after the last entry are scanned (see buildIndex).
+    A missing index is built and saved; an existing one is only extended in memory, since the logger may be appending to it.
+
+    Parameters
+    ----------
+    path: str
+        CSV log
+    every: float
+        Time between two entries of the index built, in seconds
+
+    Returns
+    -------
+    numpy.ndarray
+        Index (indexDtype)
+    """
+    idxPath = indexPath(path)
+    if not os.path.exists(idxPath):
+        index = buildIndex(path, every)
+        index.tofile(idxPath)
+        return index
+    size = os.path.getsize(path)
+    index = np.fromfile(idxPath, dtype=indexDtype, count=os.path.getsize(idxPath) // indexDtype.itemsize)
+    index = index[index['offset'] < size]
+    return buildIndex(path, every, index)
+
+def seekOffset(path, start):
+    """
+    Byte offset of the CSV log from which the rows from start on are found
+
+    Parameters
+    ----------
+    path: str
+        CSV log
+    start: float
+        Unix time
+
+    Returns
+    -------
+    int
+        Offset of a row start; 0 when start precedes the indexed rows
+    """
+    index = loadIndex(path)
+    # The index keeps the integer part of the timestamps: an entry before floor(start) is surely before start
+    it = np.searchsorted(index['ts'], np.floor(start), side='left') - 1
+    return int(index['offset'][it]) if it >= 0 else 0
+
+class _ByteRange:
+    """
+    File-like view of a byte range of an open binary file, from its current position
+    """
+    def __init__(self, file, size):
+        self.file = file
+        self.left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.file.read(size)
+        self.left -= len(data)
+        return data
+
+class LogCache:
+    """
+    Cache of the parsed CSV logs, stored as binary logs with float64 values in a local directory.
+    An entry is keyed by the path of the log and validated by its size and modification time:
+    when the log has grown (the end of the cached part is unchanged), only the new rows are parsed and appended.
+    The least recently used entries are deleted when the cache exceeds maxBytes.
+
+    The schema of each entry has a 'source' field: path, size, mtime of the log, byte offset and hash of the end of the parsed part,
+    number of records and time of last use.
+    """
+    def __init__(self, directory=cacheDir, maxBytes=2**31):
+        """
+        Parameters
+        ----------
+        directory: str
+            Directory of the cache, created if missing
+        maxBytes: int
+            Maximum size of the cache, in bytes
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _base(self, path):
+        return os.path.join(self.directory, hashlib.sha1(os.path.abspath(path).encode()).hexdigest())
+
+    @staticmethod
+    def _tail(path, offset):
+        """
+        Hash of the bytes before offset
+        """
+        with open(path, 'rb') as f:
+            f.seek(max(offset - 4096, 0))
+            return hashlib.sha1(f.read(offset - f.tell())).hexdigest()
+
+    @staticmethod
+    def _lastLineEnd(path, size):
+        """
+        Offset after the last complete line within size bytes
+        """
+        with open(path, 'rb') as f:
+            end = size
+            while end > 0:
+                f.seek(max(end - 65536, 0))
+                block = f.read(end - f.tell())
+                pos = block.rfind(b'\n')
+                if pos >= 0:
+                    return end - len(block) + pos + 1
+                end -= len(block)
+        return 0
+
+    @staticmethod
+    def _writeSchema(base, schema):
+        tmp = base + '.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(schema, f, indent=1)
+        os.replace(tmp, base + '.json')
+
+    def load(self, path, chunksize=100000):
+        """
+        Parsed log, from the cache when valid; the cache is updated with the rows not cached yet
+
+        Parameters
+        ----------
+        path: str
+            CSV log
+        chunksize: int
+            Rows parsed at a time
+
+        Returns
+        -------
+        numpy.ndarray
+            Records (structured array: Timestamp and the columns), memory-mapped
+        """
+        stat = os.stat(path)
+        base = self._base(path)
+        schema = None
+        if os.path.exists(base + '.json'):
+            with open(base + '.json') as f:
+                schema = json.load(f)
+            source = schema['source']
+            if source['path'] != os.path.abspath(path) or stat.st_size < source['size'] or self._tail(path, source['offset']) != source['tail']:
+                # Rewritten log
+                schema = None
+        if schema is None:
+            # Parse from the first row: skip the comments and the header
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    offset += len(line)
+                    if not line.startswith(b'#'):
+                        break
+            columns = [str(col) for col in pd.read_csv(path, comment='#', nrows=0).columns[1:]]
+            schema = dict(format='tvac-bin', version=1, time='<f8', dtype='<f8', columns=columns, comments=[],
+                          source=dict(path=os.path.abspath(path), size=0, mtime=0, offset=offset, tail=self._tail(path, offset), records=0, used=0))
+            open(base + '.bin', 'wb').close()
+        source = schema['source']
+        if (stat.st_size, stat.st_mtime_ns) != (source['size'], source['mtime']):
+            self._append(path, base, schema, stat, chunksize)
+        source['used'] = time.time()
+        self._writeSchema(base, schema)
+        self.evict(keep=base)
+        records = readBinary(base)[1]
+        return records[:source['records']]
+
+    def _append(self, path, base, schema, stat, chunksize):
+        """
+        Parse the complete rows of the log after the cached ones and append them to the entry
+        """
+        source = schema['source']
+        dtype = recordDtype(schema)
+        end = self._lastLineEnd(path, stat.st_size)
+        # Records beyond the count of the schema come from an interrupted update
+        if os.path.getsize(base + '.bin') != source['records'] * dtype.itemsize:
+            os.truncate(base + '.bin', source['records'] * dtype.itemsize)
+        if end > source['offset']:
+            with open(path, 'rb') as f, open(base + '.bin', 'ab') as out:
+                f.seek(source['offset'])
+                reader = pd.read_csv(_ByteRange(f, end - source['offset']), comment='#', header=None,
+                                     names=['Timestamp'] + schema['columns'], chunksize=chunksize)
+                for chunk in reader:
+                    # Header lines are not numbers: drop them
+                    chunk = chunk.apply(pd.to_numeric, errors='coerce').dropna(subset=['Timestamp'])
+                    data = np.empty(len(chunk), dtype=dtype)
+                    for it, col in enumerate(dtype.names):
+                        data[col] = chunk.iloc[:, it].to_numpy(dtype=float)
+                    out.write(data.tobytes())
+                    source['records'] += len(data)
+        source.update(size=stat.st_size, mtime=stat.st_mtime_ns, offset=end, tail=self._tail(path, end))
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used entries, until the cache is within maxBytes
+
+        Parameters
+        ----------
+        keep: str
+            Entry not to delete (base path)
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                base = os.path.join(self.directory, name[:-5])
+                try:
+                    with open(base + '.json') as f:
+                        used = json.load(f)['source']['used']
+                    entries.append((used, base, os.path.getsize(base + '.bin')))
+                except (OSError, ValueError, KeyError):
+                    continue
+        total = sum(size for _, _, size in entries)
+        for used, base, size in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            if base == keep:
+                continue
+            for ext in ('.json', '.bin'):
+                try:
+                    os.remove(base + ext)
+                except OSError:
+                    pass
+            total -= size
+
+def csvToBinary(csvPath, base=None, chunksize=100000):
+    """
+    Convert a CSV log to a binary log.
+    The comments before the header are kept; the logs of psuInterface, whose header is a comment ('#Time Stamp, ...'), are supported.
+
+    Parameters
+    ----------
+    csvPath: str
+        CSV log
+    base: str
+        Path of the binary log, without extension; default: the CSV path without extension
+    chunksize: int
+        Rows converted at a time
+
+    Returns
+    -------
+    int
+        Number of rows converted
+    """
+    if base is None:
+        base = os.path.splitext(csvPath)[0]
+    comments = []
+    with open(csvPath) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            comments.append(line[1:].rstrip('\n'))
+    names = None
+    for it, text in enumerate(comments):
+        if text.startswith('Time Stamp'):
+            names = ['Timestamp'] + [col.strip() for col in comments.pop(it).split(',')[1:]]
+            break
+    options = dict(comment='#', header=None if names else 0, names=names)
+    rows = 0
+    with BinaryLog(base) as log:
+        for text in comments:
+            log.comment(text)
+        log.header(pd.read_csv(csvPath, nrows=0, **options).columns[1:])
+        for chunk in pd.read_csv(csvPath, chunksize=chunksize, **options):
+            # Header lines repeated by a new logging session are not numbers: drop them
+            chunk = chunk.apply(pd.to_numeric, errors='coerce').dropna(subset=[chunk.columns[0]])
+            data = np.empty(len(chunk), dtype=log.recordDtype)
+            for it, col in enumerate(data.dtype.names):
+                data[col] = chunk.iloc[:, it].to_numpy(dtype=float)
+            log.file.write(data.tobytes())
+            rows += len(chunk)
+    return rows
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('Usage:')
+        print('\ttvacStorage.py <CSV log> [binary log, without extension]')
+        sys.exit()
+    rows = csvToBinary(*sys.argv[1:])
+    print(f'{rows} rows converted')
@@ -1,5 +1,9 @@
+import os
 import time
+import atexit
+import threading
 import datetime
+import numpy as np
 import pyqtgraph as pg
 
 class TimeAxisItem(pg.AxisItem):
@@ -25,4 +29,317 @@ def tsToStr(ts):
     """
     Local unix time in readabe format
     """
-    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y%m%d-%H%M%S")
\ No newline at end of file
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y%m%d-%H%M%S")
+
+class RingBuffer:
+    """
+    Fixed-size circular buffer of timestamps and N-channel samples, for the live plots.
+    Each sample is written twice (at i and i+capacity), so the stored history is always a contiguous slice:
+    times() and channel() return views that can be passed to setData without copies.
+    """
+    def __init__(self, channels, window, period):
+        """
+        Parameters
+        ----------
+        channels: int
+            Number of channels
+        window: float
+            Time span to keep, in seconds
+        period: float
+            Expected sampling period, in seconds
+        """
+        self.channels = channels
+        self.capacity = int(np.ceil(window / period)) + 1
+        self._time = np.zeros(2*self.capacity)
+        self._data = np.zeros((channels, 2*self.capacity))
+        self._head = 0 # Next write position, in [0, capacity)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, ts, values):
+        """
+        Append a sample, overwriting the oldest one when the buffer is full
+
+        Parameters
+        ----------
+        ts: float
+            Timestamp of the sample
+        values: array-like
+            One value per channel
+        """
+        it = self._head
+        self._time[it] = self._time[it+self.capacity] = ts
+        self._data[:, it] = self._data[:, it+self.capacity] = values
+        self._head = (it + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def _slice(self):
+        end = self._head + self.capacity
+        return slice(end - self.size, end)
+
+    def times(self):
+        """
+        Timestamps of the stored samples, oldest first (view)
+        """
+        return self._time[self._slice()]
+
+    def channel(self, ch):
+        """
+        Stored values of a channel, oldest first (contiguous view)
+        """
+        return self._data[ch, self._slice()]
+
+    def data(self):
+        """
+        Stored values of all the channels, shape (channels, size), oldest first (view)
+        """
+        return self._data[:, self._slice()]
+
+def minMaxDecimate(x, y, bins):
+    """
+    Min/max envelope decimation of several series sharing the same x.
+    Each bin is replaced by its minimum and maximum, so peaks and glitches stay visible at any zoom level.
+
+    Parameters
+    ----------
+    x: numpy.ndarray
+        Abscissa, shape (n,)
+    y: numpy.ndarray
+        Values, shape (channels, n)
+    bins: int
+        Number of bins (usually the width in pixels of the plot)
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Decimated x, shape (m,), and y, shape (channels, m), with m <= 2*bins; the inputs if already small enough
+    """
+    n = len(x)
+    if n <= 2*bins:
+        return x, y
+    step = int(np.ceil(n / bins))
+    starts = np.arange(0, n, step)
+    ends = np.minimum(starts + step, n) - 1
+    xd = np.empty(2*len(starts))
+    xd[0::2] = x[starts]
+    xd[1::2] = x[ends]
+    yd = np.empty((y.shape[0], 2*len(starts)))
+    yd[:, 0::2] = np.minimum.reduceat(y, starts, axis=1)
+    yd[:, 1::2] = np.maximum.reduceat(y, starts, axis=1)
+    return xd, yd
+
+class LodPlot:
+    """
+    Level-of-detail layer between a RingBuffer and the curves of a plot.
+    The buffer keeps the full-resolution data; the curves get only the visible range,
+    min/max decimated to the width in pixels of the plot, recomputed on new data, zoom, pan and resize.
+    """
+    def __init__(self, plot_graph, curves, buffer):
+        """
+        Parameters
+        ----------
+        plot_graph: pyqtgraph.PlotWidget
+            Plot containing the curves
+        curves: list of PlotDataItem
+            One curve per channel of the buffer
+        buffer: RingBuffer
+            Full-resolution data
+        """
+        self.plot_graph = plot_graph
+        self.curves = curves
+        self.buffer = buffer
+        self._busy = False
+        view = self.plot_graph.getViewBox()
+        view.sigXRangeChanged.connect(self.refresh)
+        view.sigResized.connect(self.refresh)
+
+    def refresh(self, *args):
+        """
+        Recompute the decimated curves for the current view
+        """
+        if self._busy or len(self.buffer) == 0:
+            return
+        self._busy = True
+        try:
+            x = self.buffer.times()
+            y = self.buffer.data()
+            view = self.plot_graph.getViewBox()
+            if view.autoRangeEnabled()[0]:
+                # Auto range: the whole history is visible
+                first, last = 0, len(x)
+            else:
+                # Visible range, plus one point per side to draw the lines to the borders
+                xmin, xmax = view.viewRange()[0]
+                first = max(np.searchsorted(x, xmin) - 1, 0)
+                last = min(np.searchsorted(x, xmax, side='right') + 1, len(x))
+            xd, yd = minMaxDecimate(x[first:last], y[:, first:last], max(int(view.width()), 100))
+            for ch, curve in enumerate(self.curves):
+                curve.setData(xd, yd[ch])
+        finally:
+            self._busy = False
+
+class BufferedLogWriter:
+    """
+    File writer for the logs that batches the lines in memory and writes them from a background thread,
+    when the buffered data exceed max_bytes, when the oldest line is older than max_age seconds, on flush and on close.
+    The writes on the acquisition path only append to a list; the counters report the activity of the writer.
+    In binary mode ('wb', 'ab') the writer takes bytes, and each write counts as a line (one record).
+    Pending lines are written at the interpreter exit if the writer was not closed.
+    If a write fails, the batch is dropped and the error is raised once, by the following write, flush or close;
+    the later writes go on normally. The failures are counted in stats.
+    """
+    def __init__(self, path, mode='w', max_bytes=65536, max_age=1.0, fsync=False, encoding=None, newline=None):
+        """
+        Parameters
+        ----------
+        path: str
+            Log file
+        mode: str
+            Open mode of the file: 'w', 'a', 'wb' or 'ab'
+        max_bytes: int
+            Buffered size that triggers a write, in bytes
+        max_age: float
+            Maximum time a line stays in memory, in seconds
+        fsync: bool
+            Also commit each write to the disk (os.fsync), not only to the OS cache
+        encoding: str
+            Encoding of the text modes; default: the locale encoding
+        newline: str
+            Newline translation of the text modes, as in open; default: the platform line ending
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.bytes_written = 0
+        self.lines_written = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.
+        self.max_flush_latency = 0.
+        self.write_errors = 0
+        self.last_error = None
+        self._file = open(path, mode, encoding=encoding, newline=newline)
+        self._binary = 'b' in mode
+        self._buffer = []
+        self._size = 0
+        self._first = None
+        self._requested = 0
+        self._done = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='log '+os.path.basename(path), daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _raise(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def write(self, text):
+        """
+        Buffer text, to be written by the background thread
+        """
+        if self._closed:
+            raise ValueError('I/O operation on closed log ' + self.path)
+        with self._cond:
+            self._raise()
+            if not self._buffer:
+                # First line of a batch: the thread starts the max_age timer
+                self._first = time.monotonic()
+                self._cond.notify()
+            self._buffer.append(text)
+            self._size += len(text)
+            if self._size >= self.max_bytes:
+                self._cond.notify()
+        return len(text)
+
+    def flush(self):
+        """
+        Write the buffered text now, and wait for the write to complete
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._requested += 1
+            ticket = self._requested
+            self._cond.notify()
+            self._cond.wait_for(lambda: self._done >= ticket or self._closed)
+            self._raise()
+
+    def close(self):
+        """
+        Write the buffered text, stop the background thread and close the file
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        atexit.unregister(self.close)
+        try:
+            self._file.close()
+        except OSError as e:
+            self._error = self._error or e
+        self._raise()
+
+    def stats(self):
+        """
+        Counters of the writer: bytes, lines and writes done, latency of the last and slowest write (seconds),
+        failed writes and the last error
+        """
+        return dict(bytes=self.bytes_written, lines=self.lines_written, flushes=self.flushes,
+                    last_latency=self.last_flush_latency, max_latency=self.max_flush_latency,
+                    errors=self.write_errors, last_error=self.last_error)
+
+    def _due(self):
+        return (self._closed or self._requested > self._done or self._size >= self.max_bytes
+                or (self._buffer and time.monotonic() - self._first >= self.max_age))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = self.max_age - (time.monotonic() - self._first) if self._buffer else None
+                    self._cond.wait(timeout)
+                chunks, self._buffer, self._size = self._buffer, [], 0
+                ticket = self._requested
+                closing = self._closed
+            if chunks:
+                start = time.monotonic()
+                text = (b'' if self._binary else '').join(chunks)
+                try:
+                    self._file.write(text)
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                except Exception as e:
+                    with self._cond:
+                        self._error = self._error or e
+                        self.write_errors += 1
+                        self.last_error = e
+                else:
+                    self.last_flush_latency = time.monotonic() - start
+                    self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+                    self.bytes_written += len(text) if self._binary else len(text.encode(self._file.encoding, self._file.errors))
+                    self.lines_written += len(chunks) if self._binary else text.count('\n')
+                    self.flushes += 1
+            with self._cond:
+                self._done = ticket
+                self._cond.notify_all()
+            if closing:
+                break